@@ -1,60 +1,55 @@
-import requests
 import os
-import cv2
 import base64
 import asyncio
-from minio import Minio
+import json
 from sqlalchemy.orm import Session
-from cache import get_cached_summary, set_cached_summary
+from sqlalchemy.dialects.postgresql import insert
+from cache import get_cached_summary, set_cached_summary, set_cached_summary_if_current, summary_lock_held, release_summary_lock, summary_waiters
+import cache
+from ollama_client import OllamaClient, ModelScheduler
+import frames
+import metrics
 import models
+import search
+from database import SessionLocal
 
-OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434/api/generate")
 VISION_MODEL = "moondream"   # The Eyes
 TEXT_MODEL = "llama3.2:1b"   # The Brain
 
-MINIO_CLIENT = Minio(
-    os.getenv("S3_ENDPOINT", "http://minio:9000").replace("http://", "").replace("https://", ""),
-    access_key=os.getenv("S3_ACCESS_KEY", "minioadmin"),
-    secret_key=os.getenv("S3_SECRET_KEY", "minioadmin"),
-    secure=os.getenv("S3_ENDPOINT", "http://minio:9000").startswith("https")
-)
-
-def get_frame_at_percentage(video_path, percentage):
-    """Extracts a single frame at a specific percentage (0.2, 0.5, 0.8)"""
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened(): return None
+# More frames give better summaries; vision calls run in parallel (up to the
+# per-model limit), so latency grows with frames / VISION_CONCURRENCY.
+SUMMARY_FRAME_COUNT = int(os.getenv("SUMMARY_FRAME_COUNT", 3))
+VISION_CONCURRENCY = int(os.getenv("OLLAMA_VISION_CONCURRENCY", 4))
+TEXT_CONCURRENCY = int(os.getenv("OLLAMA_TEXT_CONCURRENCY", 1))
+VISION_TIMEOUT = float(os.getenv("OLLAMA_VISION_TIMEOUT", 60))
+TEXT_TIMEOUT = float(os.getenv("OLLAMA_TEXT_TIMEOUT", 120))
 
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    cap.set(cv2.CAP_PROP_POS_FRAMES, int(total_frames * percentage))
+# Stage requests from all summaries in this process are batched per model,
+# so concurrent jobs don't make Ollama swap moondream and llama back and forth.
+# Stream the synthesis to the browser as summary_delta messages, batched so
+# a CPU-bound model emitting single tokens doesn't mean one push per token.
+SUMMARY_STREAMING = os.getenv("SUMMARY_STREAMING", "on") == "on"
+SUMMARY_DELTA_INTERVAL = float(os.getenv("SUMMARY_DELTA_INTERVAL", 0.1))
 
-    ret, frame = cap.read()
-    cap.release()
-
-    if not ret: return None
-    _, buffer = cv2.imencode('.jpg', frame)
-    return base64.b64encode(buffer).decode('utf-8')
+ollama = ModelScheduler(
+    OllamaClient(concurrency={VISION_MODEL: VISION_CONCURRENCY, TEXT_MODEL: TEXT_CONCURRENCY})
+)
 
-def analyze_image_with_moondream(image_b64):
+async def analyze_image_with_moondream(image_b64):
     """Asks Moondream to describe technical details in the image"""
     prompt = "Describe the software interface in this image. List any visible buttons, text inputs, headers, or specific words like 'Chat', 'Model', 'AI', or code."
 
     try:
-        response = requests.post(OLLAMA_URL, json={
-            "model": VISION_MODEL,
-            "prompt": prompt,
-            "images": [image_b64],
-            "stream": False
-        }, timeout=120)
-        return response.json().get("response", "")
+        return await ollama.generate(VISION_MODEL, prompt, images=[image_b64], timeout=VISION_TIMEOUT)
     except Exception as e:
         print(f"   Moondream request failed: {e}")
         return ""
 
-def synthesize_final_summary(descriptions):
+async def synthesize_final_summary(descriptions, on_token=None):
     """Asks Llama 3.2 to combine descriptions into a factual summary"""
     combined_text = "\n".join([f"- Frame {i+1}: {desc}" for i, desc in enumerate(descriptions)])
     prompt = (
-        f"You are a visual analysis AI. Here are descriptions of three frames from a video:\n\n"
+        f"You are a visual analysis AI. Here are descriptions of {len(descriptions)} frames from a video:\n\n"
         f"{combined_text}\n\n"
         f"Task: Identify the subject matter and write a 3-sentence summary.\n"
         f"1. Analyze the visual cues. Are they organic (nature, people) or digital (screens, games)?\n"
@@ -65,96 +60,289 @@ def synthesize_final_summary(descriptions):
     )
 
     try:
-        response = requests.post(OLLAMA_URL, json={
-            "model": TEXT_MODEL,
-            "prompt": prompt,
-            "stream": False
-        }, timeout=120)
-        return response.json().get("response", "Analysis failed.")
+        return await ollama.generate(TEXT_MODEL, prompt, timeout=TEXT_TIMEOUT, on_token=on_token) or "Analysis failed."
     except Exception as e:
         print(f"   Llama synthesis request failed: {e}")
         return "Could not synthesize summary."
 
-def generate_summary_stream(video_id: str, video_title: str, db: Session, ignore_cache: bool = False):
-    if not ignore_cache:
-        cached = get_cached_summary(video_id)
-        if cached: return cached
+async def describe_frames(jpegs):
+    """
+    Vision descriptions for a list of frames, reusing work for near-identical
+    frames: first within this batch (screen recordings often repeat), then
+    across videos via the perceptual-hash cache in Redis. Only frames with
+    no close match go to the vision model, all at once.
+    """
+    hashes = await asyncio.gather(*(asyncio.to_thread(frames.dhash, jpeg) for jpeg in jpegs))
+
+    async def lookup(frame_hash):
+        if frame_hash is None:
+            return None
+        try:
+            return await asyncio.to_thread(cache.get_frame_description, frame_hash)
+        except Exception as e:
+            print(f"   Frame cache lookup failed: {e}")
+            return None
+
+    async def analyze(jpeg, frame_hash):
+        description = await analyze_image_with_moondream(base64.b64encode(jpeg).decode('utf-8'))
+        if description and frame_hash is not None:
+            try:
+                evicted = await asyncio.to_thread(cache.set_frame_description, frame_hash, description)
+                if evicted:
+                    metrics.incr_deferred("frame_cache.evictions", evicted)
+            except Exception as e:
+                print(f"   Frame cache store failed: {e}")
+        return description
+
+    # Frames close to an earlier one in this batch share its result.
+    leaders = []
+    owner = []
+    for i, frame_hash in enumerate(hashes):
+        match = next((j for j in leaders if frame_hash is not None and hashes[j] is not None
+                      and cache.hamming(frame_hash, hashes[j]) <= cache.FRAME_HASH_MAX_DISTANCE), None)
+        if match is None:
+            leaders.append(i)
+            owner.append(i)
+        else:
+            owner.append(match)
+
+    cached = dict(zip(leaders, await asyncio.gather(*(lookup(hashes[i]) for i in leaders))))
+    misses = [i for i in leaders if cached[i] is None]
+    fresh = dict(zip(misses, await asyncio.gather(*(analyze(jpegs[i], hashes[i]) for i in misses))))
+
+    metrics.incr_deferred("frame_cache.hits", len(jpegs) - len(misses))
+    metrics.incr_deferred("frame_cache.misses", len(misses))
+    return [cached[owner[i]] if cached[owner[i]] is not None else fresh[owner[i]] for i in range(len(jpegs))]
+
+class SummaryDeltaStream:
+    """
+    Collects synthesis tokens and pushes them as summary_delta messages at
+    most every SUMMARY_DELTA_INTERVAL. `recipients` is called at each flush
+    so users who join the single-flight wait mid-stream start receiving too.
+    """
+
+    def __init__(self, video_id: str, video_title: str, recipients):
+        self.video_id = video_id
+        self.video_title = video_title
+        self.recipients = recipients
+        self.seq = 0
+        self._buffer = []
+        self._pending = None
+        self._lock = asyncio.Lock()
+
+    def on_token(self, chunk: str):
+        self._buffer.append(chunk)
+        if self._pending is None:
+            self._pending = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(SUMMARY_DELTA_INTERVAL)
+        self._pending = None
+        await self.flush()
+
+    async def flush(self):
+        import notifications
+
+        # The lock keeps deltas in order when a push is slower than the interval.
+        async with self._lock:
+            if not self._buffer:
+                return
+            message = {
+                "type": "summary_delta",
+                "video_id": self.video_id,
+                "video_title": self.video_title,
+                "delta": "".join(self._buffer),
+                "seq": self.seq,
+            }
+            self._buffer.clear()
+            self.seq += 1
+            recipients = await asyncio.to_thread(self.recipients)
+            await asyncio.gather(*(notifications.deliver(uid, message) for uid in recipients))
+
+    async def close(self, discard: bool = False):
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        if discard:
+            self._buffer.clear()
+        await self.flush()
+
+class SummarySuperseded(Exception):
+    """A forced regeneration took over while this job was running."""
+
+def save_summary(db: Session, video_id: str, summary_text: str):
+    """Insert or replace the summary; a job that lost a race must not hit the unique key."""
+    stmt = insert(models.VideoSummary).values(video_id=video_id, summary_text=summary_text)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[models.VideoSummary.video_id],
+        set_={"summary_text": stmt.excluded.summary_text, "created_at": stmt.excluded.created_at},
+    ))
+    db.commit()
 
+# The summary job runs on the AI worker's shared event loop, so its database
+# and Redis work goes through these blocking helpers in a worker thread, each
+# with its own session.
+def _stored_summary(video_id: str):
+    """The cached or saved summary, or None."""
+    cached = get_cached_summary(video_id)
+    if cached: return cached
+    db = SessionLocal()
+    try:
         db_summary = db.query(models.VideoSummary).filter(models.VideoSummary.video_id == video_id).first()
-        if db_summary:
-            set_cached_summary(video_id, db_summary.summary_text)
-            return db_summary.summary_text
+        summary_text = db_summary.summary_text if db_summary else None
+    finally:
+        db.close()
+    if summary_text:
+        set_cached_summary(video_id, summary_text)
+    return summary_text
 
-    if ignore_cache:
-        print(f"Force regenerating for {video_id}...")
+def _clear_summary(video_id: str):
+    db = SessionLocal()
+    try:
         db.query(models.VideoSummary).filter(models.VideoSummary.video_id == video_id).delete()
         db.commit()
+    finally:
+        db.close()
 
-    print(f"Analyzing video for: {video_id}")
-    video = db.query(models.VideoJob).filter(models.VideoJob.id == video_id).first()
-    if not video or not video.s3_key: return "Video not ready."
+def _frame_source(video_id: str):
+    """(s3_key, keyframe_keys) of a transcoded video, or None."""
+    db = SessionLocal()
+    try:
+        video = db.query(models.VideoJob).filter(models.VideoJob.id == video_id).first()
+        if not video or not video.s3_key: return None
+        return video.s3_key, video.keyframe_keys
+    finally:
+        db.close()
 
-    temp_filename = f"/tmp/{video_id}.mp4"
+def _store_summary(video_id: str, summary_text: str, token: str = None):
+    """
+    Save and cache the result, unless a forced regeneration has taken the
+    lock: then an older run must not overwrite (or pre-empt) the new one.
+    """
+    if token and not summary_lock_held(video_id, token):
+        raise SummarySuperseded(video_id)
+    db = SessionLocal()
     try:
-        MINIO_CLIENT.fget_object("processed-videos", video.s3_key, temp_filename)
+        save_summary(db, video_id, summary_text)
+    finally:
+        db.close()
+    if not token:
+        set_cached_summary(video_id, summary_text)
+    elif not set_cached_summary_if_current(video_id, token, summary_text):
+        # Superseded after the save; the newer run's upsert replaces the row.
+        raise SummarySuperseded(video_id)
+
+async def generate_summary_stream(video_id: str, video_title: str, ignore_cache: bool = False,
+                                  token: str = None, on_token=None):
+    if not ignore_cache:
+        stored = await asyncio.to_thread(_stored_summary, video_id)
+        if stored: return stored
+
+    if ignore_cache:
+        print(f"Force regenerating for {video_id}...")
+        await asyncio.to_thread(_clear_summary, video_id)
 
-        timestamps = [0.2, 0.5, 0.8]
-        descriptions = []
+    print(f"Analyzing video for: {video_id}")
+    source = await asyncio.to_thread(_frame_source, video_id)
+    if not source: return "Video not ready."
+    s3_key, keyframe_keys = source
+
+    async def check_current():
+        # Between stages: stop early (and keep the lock alive) unless superseded.
+        if token and not await asyncio.to_thread(summary_lock_held, video_id, token):
+            raise SummarySuperseded(video_id)
 
-        for t in timestamps:
-            img = get_frame_at_percentage(temp_filename, t)
-            if img:
-                desc = analyze_image_with_moondream(img)
-                descriptions.append(desc)
-                print(f"   Frame at {int(t*100)}%: {desc[:50]}...")
+    try:
+        if keyframe_keys:
+            # Cut by the worker during transcoding: a few KB per frame, no decoding.
+            sampled = await asyncio.to_thread(frames.load_keyframes, json.loads(keyframe_keys))
+        else:
+            # Seeks straight to the sampled keyframes over presigned range requests.
+            sampled = await asyncio.to_thread(frames.sample_frames, s3_key, SUMMARY_FRAME_COUNT)
+        await check_current()
+        descriptions = await describe_frames([jpeg for _, jpeg in sampled])
+        for (fraction, _), desc in zip(sampled, descriptions):
+            print(f"   Frame at {int(fraction*100)}%: {desc[:50]}...")
+        descriptions = [d for d in descriptions if d]
+        await check_current()
 
         if not descriptions:
             final_summary = "Could not analyze video visual content."
         else:
-            final_summary = synthesize_final_summary(descriptions)
+            final_summary = await synthesize_final_summary(descriptions, on_token=on_token)
 
-        os.remove(temp_filename)
-
-        new_summary = models.VideoSummary(video_id=video_id, summary_text=final_summary)
-        db.add(new_summary)
-        db.commit()
-        set_cached_summary(video_id, final_summary)
+        await asyncio.to_thread(_store_summary, video_id, final_summary, token)
+        await search.update_video_async(video_id, summary=final_summary)
 
         return final_summary
 
+    except SummarySuperseded:
+        raise
     except Exception as e:
         print(f"Error during analysis: {e}")
-        if os.path.exists(temp_filename):
-            os.remove(temp_filename)
         return "Analysis failed."
 
+def _video_title(video_id: str):
+    """The display title, or None if the video is gone."""
+    db = SessionLocal()
+    try:
+        video = db.query(models.VideoJob).filter(models.VideoJob.id == video_id).first()
+        return (video.title or video.filename) if video else None
+    finally:
+        db.close()
 
-async def generate_summary_background(video_id: str, user_id: int):
+async def run_summary_job(video_id: str, user_id: int, token: str = None, force: bool = False):
     """
-    Background task: generates AI summary in a thread pool (non-blocking),
-    then pushes the result to the user via WebSocket.
+    One ai_tasks job (see ai_worker.py): generates the AI summary (frame
+    sampling, database and Redis work run in threads, Ollama calls are
+    async), then pushes the
+    result to everyone waiting on it via WebSocket. `token` is this run's
+    single-flight lock; if a forced regeneration replaced it, the result is
+    dropped and the newer run notifies the waiters instead. A forced run
+    (`force`) never reads the cached or saved summary.
     """
-    from ws_manager import manager
+    import notifications
 
-    def _run():
-        from database import SessionLocal
-        db = SessionLocal()
-        try:
-            video = db.query(models.VideoJob).filter(models.VideoJob.id == video_id).first()
-            if not video:
-                return "Video not found.", None
-            return generate_summary_stream(video_id, video.title or video.filename, db, ignore_cache=False), video.title or video.filename
-        except Exception as e:
-            print(f"Background summary error: {e}")
-            return "Analysis failed.", None
-        finally:
-            db.close()
+    stream = None
+    try:
+        video_title = await asyncio.to_thread(_video_title, video_id)
+        if video_title is None:
+            summary = "Video not found."
+        else:
+            if SUMMARY_STREAMING:
+                stream = SummaryDeltaStream(
+                    video_id, video_title,
+                    lambda: {user_id, *summary_waiters(video_id)} if token else {user_id},
+                )
+            summary = await generate_summary_stream(
+                video_id, video_title, ignore_cache=force, token=token,
+                on_token=stream.on_token if stream else None,
+            )
+    except SummarySuperseded:
+        print(f"Summary for {video_id} superseded by a forced regeneration; dropping result")
+        if stream:
+            await stream.close(discard=True)
+        return
+    except Exception as e:
+        print(f"Background summary error: {e}")
+        summary, video_title = "Analysis failed.", None
+
+    # Remaining deltas go out before summary_ready, which carries the full text.
+    if stream:
+        await stream.close()
 
-    summary, video_title = await asyncio.to_thread(_run)
+    recipients = {user_id}
+    if token:
+        waiters = await asyncio.to_thread(release_summary_lock, video_id, token)
+        if waiters is None:
+            print(f"Summary for {video_id} superseded by a forced regeneration; not notifying")
+            return
+        recipients.update(waiters)
 
-    await manager.send_personal_message({
+    message = {
         "type": "summary_ready",
         "video_id": video_id,
         "summary": summary,
         "video_title": video_title or video_id
-    }, user_id)
+    }
+    await asyncio.gather(*(notifications.deliver(uid, message) for uid in recipients))
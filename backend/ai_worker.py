@@ -0,0 +1,90 @@
+"""
+AI summary worker: consumes the durable ai_tasks queue.
+
+Summaries are mostly waiting — on ffmpeg seeks and on Ollama — so a single
+asyncio loop (in its own thread) runs up to AI_WORKER_CONCURRENCY jobs at
+once, while the main thread owns the pika connection. Messages are acked
+only when their job has finished, so anything in flight when the worker
+stops is redelivered to the next one.
+"""
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+
+import pika
+
+from tasks import AI_QUEUE
+import ai_utils
+
+AI_WORKER_CONCURRENCY = int(os.getenv("AI_WORKER_CONCURRENCY", 4))
+
+
+class AsyncConsumer:
+    """Runs each delivery as a coroutine on a background event loop."""
+
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="ai-loop", daemon=True)
+        self.thread.start()
+
+    def on_message(self, ch, method, properties, body):
+        try:
+            message = json.loads(body)
+            video_id, user_id = message["video_id"], message["user_id"]
+        except (ValueError, KeyError) as e:
+            print(f" [!] Dropping malformed AI task: {e}")
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        print(f" [x] Summarizing {video_id} for user {user_id}")
+        future = asyncio.run_coroutine_threadsafe(
+            ai_utils.run_summary_job(video_id, user_id, message.get("token"), message.get("force", False)),
+            self.loop,
+        )
+        future.add_done_callback(functools.partial(self._on_done, method.delivery_tag, video_id))
+
+    def _on_done(self, delivery_tag, video_id, future):
+        # Runs on the event-loop thread; pika must only be touched from its own thread.
+        error = "cancelled" if future.cancelled() else future.exception()
+        if error:
+            print(f" [!] Summary job for {video_id} crashed: {error}")
+        else:
+            print(f" [✓] Summary job for {video_id} done")
+        self.connection.add_callback_threadsafe(
+            functools.partial(self.channel.basic_ack, delivery_tag=delivery_tag)
+        )
+
+
+def main():
+    rabbitmq_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
+    rabbitmq_user = os.getenv("RABBITMQ_USER", "guest")
+    rabbitmq_pass = os.getenv("RABBITMQ_PASS", "guest")
+    credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_pass)
+
+    connection = None
+    while not connection:
+        try:
+            connection = pika.BlockingConnection(
+                pika.ConnectionParameters(host=rabbitmq_host, credentials=credentials, heartbeat=60)
+            )
+        except Exception:
+            print("Retrying RabbitMQ...")
+            time.sleep(5)
+
+    channel = connection.channel()
+    channel.queue_declare(queue=AI_QUEUE, durable=True)
+    # Unacked deliveries are the concurrency limit.
+    channel.basic_qos(prefetch_count=AI_WORKER_CONCURRENCY)
+    consumer = AsyncConsumer(connection, channel)
+    channel.basic_consume(queue=AI_QUEUE, on_message_callback=consumer.on_message)
+
+    print(f' [*] AI Worker Ready (up to {AI_WORKER_CONCURRENCY} concurrent summaries)')
+    channel.start_consuming()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+WebSocket fan-out benchmark for ws_manager.ConnectionManager.
+
+Starts a throwaway API process that only serves /ws/{user_id} (same handler
+shape as main.py), opens many client sockets against it and reports:
+
+  * connect rate and server RSS with N idle sockets,
+  * that the sockets survive several heartbeat rounds (ping/pong),
+  * that clients which stop answering pings are evicted,
+  * push-to-receive latency (p50/p95/p99) when every user gets messages.
+
+Usage (from backend/):
+    REDIS_HOST=localhost python benchmarks/ws_fanout.py --connections 10000
+
+Both processes run on this machine, so each needs N file descriptors; the
+script raises its own soft limit to the hard limit. The clients share one
+Python process, so at high counts the fan-out latency mostly measures how
+fast that process can read; the server-side figures are the ones to watch.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# --- server side ---------------------------------------------------------------
+
+def serve(port: int):
+    sys.path.insert(0, BACKEND_DIR)
+    import uvicorn
+    from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+    from ws_manager import manager
+
+    app = FastAPI()
+
+    @app.websocket("/ws/{user_id}")
+    async def websocket_endpoint(websocket: WebSocket, user_id: int):
+        connection = await manager.connect(user_id, websocket)
+        try:
+            while True:
+                await websocket.receive_text()
+                connection.mark_alive()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            manager.disconnect(connection)
+
+    @app.post("/bench/push")
+    async def push(rounds: int = 1):
+        # One video_update per round plus one unique message, to every user.
+        for i in range(rounds):
+            for user_id in list(manager.active_connections):
+                await manager.send_personal_message(
+                    {"type": "video_update", "video_id": "bench", "status": "processing", "progress": i}, user_id)
+                await manager.send_personal_message(
+                    {"type": "bench", "round": i, "sent_at": time.time()}, user_id)
+        return {"users": len(manager.active_connections)}
+
+    @app.get("/bench/stats")
+    def stats():
+        rss_kb = 0
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss_kb = int(line.split()[1])
+        return {"connections": manager.connection_count(), "rss_mb": round(rss_kb / 1024, 1)}
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", ws_ping_interval=None)
+
+
+# --- client side ---------------------------------------------------------------
+
+class Client:
+    def __init__(self, user_id, answer_pings=True):
+        self.user_id = user_id
+        self.answer_pings = answer_pings
+        self.pings = 0
+        self.latencies = []
+        self.updates = 0
+        self.closed = asyncio.Event()
+        self.ws = None
+
+    async def run(self, url, opened):
+        import websockets
+        try:
+            async with websockets.connect(url, ping_interval=None, max_queue=None, open_timeout=120) as ws:
+                self.ws = ws
+                opened.set()
+                async for raw in ws:
+                    data = json.loads(raw)
+                    kind = data.get("type")
+                    if kind == "ping":
+                        self.pings += 1
+                        if self.answer_pings:
+                            await ws.send("pong")
+                    elif kind == "bench":
+                        self.latencies.append(time.time() - data["sent_at"])
+                    elif kind == "video_update":
+                        self.updates += 1
+        except Exception:
+            pass
+        finally:
+            opened.set()
+            self.closed.set()
+
+
+async def http(port, method, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: bench\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+    raw = await reader.read()
+    writer.close()
+    return json.loads(raw.split(b"\r\n\r\n", 1)[1])
+
+
+def pct(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+
+async def wait_for_server(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await http(port, "GET", "/bench/stats")
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def bench(args):
+    await wait_for_server(args.port)
+    url = f"ws://127.0.0.1:{args.port}/ws/"
+    clients = [Client(i, answer_pings=i >= args.dead) for i in range(args.connections)]
+    tasks = []
+
+    limit = asyncio.Semaphore(args.connect_concurrency)
+
+    async def open_one(client):
+        async with limit:
+            opened = asyncio.Event()
+            tasks.append(asyncio.create_task(client.run(url + str(client.user_id), opened)))
+            await opened.wait()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(open_one(c) for c in clients))
+    elapsed = time.perf_counter() - start
+    open_count = sum(1 for c in clients if not c.closed.is_set())
+    stats = await http(args.port, "GET", "/bench/stats")
+    print(f"connected    {open_count}/{args.connections} in {elapsed:.1f}s "
+          f"({open_count / elapsed:.0f}/s); server {stats['connections']} sockets, {stats['rss_mb']} MB RSS")
+
+    print(f"idling       {args.idle}s (ping every {args.ping_interval}s, timeout {args.ping_timeout}s)")
+    await asyncio.sleep(args.idle)
+    stats = await http(args.port, "GET", "/bench/stats")
+    alive = [c for c in clients if c.answer_pings]
+    dead = [c for c in clients if not c.answer_pings]
+    print(f"after idle   server {stats['connections']} sockets, {stats['rss_mb']} MB RSS; "
+          f"responsive clients open {sum(not c.closed.is_set() for c in alive)}/{len(alive)}, "
+          f"avg pings {statistics.mean(c.pings for c in alive) if alive else 0:.1f}; "
+          f"silent clients evicted {sum(c.closed.is_set() for c in dead)}/{len(dead)}")
+
+    start = time.perf_counter()
+    await http(args.port, "POST", f"/bench/push?rounds={args.rounds}")
+    push_elapsed = time.perf_counter() - start
+    expected = args.rounds * len(alive)
+    deadline = time.monotonic() + 30
+    while sum(len(c.latencies) for c in alive) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    total = time.perf_counter() - start
+    latencies = [l for c in alive for l in c.latencies]
+    updates = sum(c.updates for c in alive)
+    print(f"fan-out      {len(latencies)}/{expected} messages in {total:.2f}s "
+          f"(enqueue {push_elapsed:.2f}s); latency p50 {pct(latencies, .5):.1f}ms "
+          f"p95 {pct(latencies, .95):.1f}ms p99 {pct(latencies, .99):.1f}ms; "
+          f"status updates received {updates} of {args.rounds * len(alive)} sent (rest coalesced)")
+
+    await asyncio.gather(*(c.ws.close() for c in clients if c.ws is not None), return_exceptions=True)
+    for t in tasks:
+        t.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--dead", type=int, default=100, help="clients that never answer pings")
+    parser.add_argument("--idle", type=float, default=20)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--ping-interval", type=float, default=3)
+    parser.add_argument("--ping-timeout", type=float, default=8)
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    if args.serve:
+        serve(args.port)
+        return
+
+    env = dict(os.environ,
+               WS_PING_INTERVAL=str(args.ping_interval),
+               WS_PING_TIMEOUT=str(args.ping_timeout))
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port)],
+        env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        asyncio.run(bench(args))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
 import redis
+import redis.asyncio as aioredis
 import os
+import time
+import hashlib
+import json
 from datetime import timedelta
 
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
@@ -13,6 +17,10 @@ except Exception as e:
     print(f"⚠️ Redis connection failed: {e}")
     r = None
 
+# Async client for code running on the event loop. It connects lazily, so
+# there is nothing to check at import time.
+ar = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+
 def get_cached_summary(video_id: str):
     """Retrieve summary from RAM (Fast)"""
     if not r: return None
@@ -34,4 +42,216 @@ def check_rate_limit(user_ip: str, limit=5, window_seconds=60):
     key = f"rate_limit:{user_ip}"
     current = r.incr(key)
     if current == 1: r.expire(key, window_seconds)
-    return current <= limit
\ No newline at end of file
+    return current <= limit
+# --- SUMMARY SINGLE-FLIGHT ---
+# One generation per video at a time. The lock value is the token of the job
+# that owns the run; everyone who asked in the meantime is kept in a waiters
+# set and gets the same summary_ready push when that job finishes.
+SUMMARY_LOCK_TTL = int(os.getenv("SUMMARY_LOCK_TTL", 900))
+
+_release_summary_lock = None
+_extend_summary_lock = None
+_set_summary_if_current = None
+if r:
+    _release_summary_lock = r.register_script("""
+        if redis.call('get', KEYS[1]) ~= ARGV[1] then return false end
+        local waiters = redis.call('smembers', KEYS[2])
+        redis.call('del', KEYS[1], KEYS[2])
+        return waiters
+    """)
+    _extend_summary_lock = r.register_script("""
+        if redis.call('get', KEYS[1]) ~= ARGV[1] then return 0 end
+        return redis.call('expire', KEYS[1], ARGV[2])
+    """)
+    _set_summary_if_current = r.register_script("""
+        if redis.call('get', KEYS[1]) ~= ARGV[1] then return 0 end
+        redis.call('setex', KEYS[2], ARGV[3], ARGV[2])
+        return 1
+    """)
+
+def _summary_keys(video_id: str):
+    return f"summary_lock:{video_id}", f"summary_waiters:{video_id}"
+
+def acquire_summary_lock(video_id: str, user_id: int, token: str, force: bool = False) -> bool:
+    """
+    Register the user as a waiter. Returns True if the caller should start a
+    generation with `token`: nobody else is running one, or `force` takes over.
+    """
+    if not r: return True
+    lock_key, waiters_key = _summary_keys(video_id)
+    pipe = r.pipeline()
+    pipe.sadd(waiters_key, user_id)
+    pipe.expire(waiters_key, SUMMARY_LOCK_TTL)
+    pipe.set(lock_key, token, nx=not force, ex=SUMMARY_LOCK_TTL)
+    return bool(pipe.execute()[-1])
+
+def summary_waiters(video_id: str):
+    """Users currently waiting on the video's in-flight summary."""
+    if not r: return []
+    _, waiters_key = _summary_keys(video_id)
+    return [int(u) for u in r.smembers(waiters_key)]
+
+def summary_lock_held(video_id: str, token: str) -> bool:
+    """False once a forced regeneration has replaced this job's token."""
+    if not r: return True
+    lock_key, _ = _summary_keys(video_id)
+    return _extend_summary_lock(keys=[lock_key], args=[token, SUMMARY_LOCK_TTL]) == 1
+
+def set_cached_summary_if_current(video_id: str, token: str, summary: str, expire_hours=24) -> bool:
+    """Cache the summary only if `token` still owns the lock; False if it was superseded."""
+    if not r: return True
+    lock_key, _ = _summary_keys(video_id)
+    ttl = int(timedelta(hours=expire_hours).total_seconds())
+    return _set_summary_if_current(keys=[lock_key, f"summary:{video_id}"], args=[token, summary, ttl]) == 1
+
+def release_summary_lock(video_id: str, token: str):
+    """
+    Drop the lock if `token` still owns it and return the waiting user ids.
+    Returns None when the job was superseded (its result should be discarded).
+    """
+    if not r: return []
+    waiters = _release_summary_lock(keys=list(_summary_keys(video_id)), args=[token])
+    return None if waiters is None else [int(u) for u in waiters]
+
+# --- FRAME DESCRIPTION CACHE ---
+# Vision-model descriptions keyed by the frame's 64-bit dHash. The hash is
+# split into 4 16-bit bands, each indexing a set of full hashes, so a lookup
+# only compares against frames sharing at least one band: anything within
+# 3 bits is always found, somewhat further matches usually are. An LRU
+# sorted set bounds the number of entries.
+FRAME_CACHE_PREFIX = "framecache:v1"
+FRAME_CACHE_MAX_ENTRIES = int(os.getenv("FRAME_CACHE_MAX_ENTRIES", 50000))
+FRAME_HASH_MAX_DISTANCE = int(os.getenv("FRAME_HASH_MAX_DISTANCE", 4))
+_FRAME_BANDS = 4
+
+def _frame_bands(frame_hash: int):
+    return [
+        f"{FRAME_CACHE_PREFIX}:band:{i}:{(frame_hash >> (16 * i)) & 0xFFFF:04x}"
+        for i in range(_FRAME_BANDS)
+    ]
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+def get_frame_description(frame_hash: int):
+    """Description of the closest cached frame within FRAME_HASH_MAX_DISTANCE, or None."""
+    if not r: return None
+    pipe = r.pipeline(transaction=False)
+    for band in _frame_bands(frame_hash):
+        pipe.smembers(band)
+    candidates = {int(h, 16) for members in pipe.execute() for h in members}
+    if not candidates: return None
+
+    best = min(candidates, key=lambda h: hamming(h, frame_hash))
+    if hamming(best, frame_hash) > FRAME_HASH_MAX_DISTANCE: return None
+    description = r.get(f"{FRAME_CACHE_PREFIX}:desc:{best:016x}")
+    if description is not None:
+        r.zadd(f"{FRAME_CACHE_PREFIX}:lru", {f"{best:016x}": time.time()})
+    return description
+
+def set_frame_description(frame_hash: int, description: str) -> int:
+    """Store a description and evict least-recently-used entries; returns how many were evicted."""
+    if not r: return 0
+    key = f"{frame_hash:016x}"
+    lru_key = f"{FRAME_CACHE_PREFIX}:lru"
+    pipe = r.pipeline()
+    pipe.set(f"{FRAME_CACHE_PREFIX}:desc:{key}", description)
+    for band in _frame_bands(frame_hash):
+        pipe.sadd(band, key)
+    pipe.zadd(lru_key, {key: time.time()})
+    pipe.zcard(lru_key)
+    size = pipe.execute()[-1]
+
+    overflow = size - FRAME_CACHE_MAX_ENTRIES
+    if overflow <= 0: return 0
+    evicted = r.zpopmin(lru_key, overflow)
+    pipe = r.pipeline()
+    for old_key, _ in evicted:
+        pipe.delete(f"{FRAME_CACHE_PREFIX}:desc:{old_key}")
+        for band in _frame_bands(int(old_key, 16)):
+            pipe.srem(band, old_key)
+    pipe.execute()
+    return len(evicted)
+
+# --- SEARCH RESULT CACHE ---
+# Pages of public search results, keyed by the normalized request. Every
+# index write bumps search:gen; a cached page is only served while the
+# generation it was stored under is current. Pages computed within
+# SEARCH_CACHE_SETTLE seconds of a bump are not stored, because ES may not
+# have refreshed the change into its searcher yet.
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 30))
+SEARCH_CACHE_SETTLE = float(os.getenv("SEARCH_CACHE_SETTLE", 1.5))
+SEARCH_GEN_KEY = "search:gen"
+SEARCH_GEN_AT_KEY = "search:gen_at"
+
+def search_cache_key(query, category, sort, cursor, size) -> str:
+    normalized = " ".join((query or "").lower().split())
+    category = category if category and category != "All" else ""
+    raw = json.dumps([normalized, category, sort, cursor or "", size])
+    return f"search:page:v2:{hashlib.sha1(raw.encode()).hexdigest()}"
+
+async def get_search_page(key: str):
+    """(cached page or None, generation to store a fresh page under or None)."""
+    if not r: return None, None
+    try:
+        gen, gen_at, raw = await ar.mget(SEARCH_GEN_KEY, SEARCH_GEN_AT_KEY, key)
+    except Exception as e:
+        print(f"⚠️ Search cache unavailable: {e}")
+        return None, None
+    gen = gen or "0"
+    if raw:
+        entry = json.loads(raw)
+        if entry["gen"] == gen:
+            return entry["page"], gen
+    if gen_at and time.time() - float(gen_at) < SEARCH_CACHE_SETTLE:
+        return None, None
+    return None, gen
+
+async def set_search_page(key: str, gen: str, page):
+    if not r: return
+    try:
+        await ar.set(key, json.dumps({"gen": gen, "page": page}), ex=SEARCH_CACHE_TTL)
+    except Exception as e:
+        print(f"⚠️ Search cache unavailable: {e}")
+
+def bump_search_generation():
+    """Invalidate every cached search page."""
+    if not r: return
+    try:
+        pipe = r.pipeline()
+        pipe.incr(SEARCH_GEN_KEY)
+        pipe.set(SEARCH_GEN_AT_KEY, time.time())
+        pipe.execute()
+    except Exception as e:
+        print(f"⚠️ Could not invalidate search cache: {e}")
+
+# --- SEARCH INDEX MAINTENANCE LOCK ---
+# Index creation and rebuilds swap aliases; only one process may do that at
+# a time (several API replicas start together, and reindex.py may run too).
+SEARCH_INDEX_LOCK_KEY = "search:index_lock"
+SEARCH_INDEX_LOCK_TTL = int(os.getenv("SEARCH_INDEX_LOCK_TTL", 600))
+
+_release_search_index_lock = None
+_extend_search_index_lock = None
+if r:
+    _release_search_index_lock = r.register_script("""
+        if redis.call('get', KEYS[1]) ~= ARGV[1] then return 0 end
+        return redis.call('del', KEYS[1])
+    """)
+    _extend_search_index_lock = r.register_script("""
+        if redis.call('get', KEYS[1]) ~= ARGV[1] then return 0 end
+        return redis.call('expire', KEYS[1], ARGV[2])
+    """)
+
+def acquire_search_index_lock(token: str) -> bool:
+    if not r: return True
+    return bool(r.set(SEARCH_INDEX_LOCK_KEY, token, nx=True, ex=SEARCH_INDEX_LOCK_TTL))
+
+def extend_search_index_lock(token: str):
+    """Keep the lock alive through a long rebuild."""
+    if not r: return
+    _extend_search_index_lock(keys=[SEARCH_INDEX_LOCK_KEY], args=[token, SEARCH_INDEX_LOCK_TTL])
+
+def release_search_index_lock(token: str):
+    if not r: return
+    _release_search_index_lock(keys=[SEARCH_INDEX_LOCK_KEY], args=[token])
@@ -0,0 +1,178 @@
+"""
+Frame sampling for the AI pipeline.
+
+Frames are pulled straight from object storage instead of downloading the
+processed video: the source is probed once, then a single ffmpeg run opens
+one input per target timestamp, seeks there with HTTP range requests and
+decodes only the keyframe it lands on. Cost depends on the number of
+frames, not on the length of the video.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+
+import media
+import tasks
+
+FRAME_SAMPLE_WIDTH = int(os.getenv("FRAME_SAMPLE_WIDTH", 512))
+FRAME_SAMPLE_TIMEOUT = int(os.getenv("FRAME_SAMPLE_TIMEOUT", 120))
+# Where samples fall in the video. The default three frames land on 20/50/80%.
+SAMPLE_START = 0.2
+SAMPLE_END = 0.8
+
+
+def sample_positions(count: int):
+    """`count` evenly spaced fractions between SAMPLE_START and SAMPLE_END."""
+    if count <= 1:
+        return [0.5]
+    step = (SAMPLE_END - SAMPLE_START) / (count - 1)
+    return [round(SAMPLE_START + i * step, 4) for i in range(count)]
+
+
+def keyframe_positions():
+    """
+    Positions of the AI keyframes the worker stores for each video:
+    AI_KEYFRAME_POSITIONS ("0.1,0.5,0.9") if set, else AI_KEYFRAME_COUNT
+    evenly spaced ones.
+    """
+    explicit = os.getenv("AI_KEYFRAME_POSITIONS")
+    if explicit:
+        return [float(p) for p in explicit.split(",") if p.strip()]
+    return sample_positions(int(os.getenv("AI_KEYFRAME_COUNT", 3)))
+
+
+def load_keyframes(entries, bucket: str = "processed-videos"):
+    """Fetch stored keyframes ([{"at", "key"}, ...]) as (fraction, bytes) pairs."""
+    frames = []
+    for entry in entries:
+        try:
+            body = tasks.S3_CLIENT.get_object(Bucket=bucket, Key=entry["key"])["Body"].read()
+            frames.append((entry["at"], body))
+        except Exception as e:
+            print(f"   Could not load keyframe {entry['key']}: {e}")
+    return frames
+
+
+def _variant_playlist(master_key: str, bucket: str, work_dir: str) -> str:
+    """
+    Local copy of the lightest HLS rendition with presigned segment URLs,
+    so ffmpeg can read it without going through the playback endpoint.
+    """
+    prefix = master_key.rsplit("/", 1)[0] + "/"
+
+    def read(key):
+        return tasks.S3_CLIENT.get_object(Bucket=bucket, Key=key)["Body"].read().decode()
+
+    def presign(uri):
+        return tasks.get_presigned_url(prefix + uri, bucket, public=False) or uri
+
+    variant, lowest = None, None
+    lines = read(master_key).splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("#EXT-X-STREAM-INF:") and i + 1 < len(lines):
+            attrs = dict(
+                part.split("=", 1) for part in line.split(":", 1)[1].split(",") if "=" in part
+            )
+            bandwidth = int(attrs.get("BANDWIDTH", 0) or 0)
+            if lowest is None or bandwidth < lowest:
+                variant, lowest = lines[i + 1].strip(), bandwidth
+    if variant is None:
+        raise ValueError(f"No variants in {master_key}")
+
+    rewritten = []
+    for line in read(prefix + variant).splitlines():
+        if line.startswith("#EXT-X-MAP:") and 'URI="' in line:
+            head, rest = line.split('URI="', 1)
+            uri, tail = rest.split('"', 1)
+            line = f'{head}URI="{presign(uri)}"{tail}'
+        elif line and not line.startswith("#"):
+            line = presign(line)
+        rewritten.append(line)
+
+    path = os.path.join(work_dir, "variant.m3u8")
+    with open(path, "w") as f:
+        f.write("\n".join(rewritten) + "\n")
+    return path
+
+
+def sample_frames(s3_key: str, count: int = 3, bucket: str = "processed-videos",
+                  positions=None, width: int = FRAME_SAMPLE_WIDTH):
+    """
+    JPEG bytes for `count` frames spread across the video (or at the given
+    `positions`), as a list of (fraction, bytes). Frames that could not be
+    decoded are left out.
+    """
+    work_dir = tempfile.mkdtemp(prefix="frames_")
+    try:
+        if s3_key.endswith(".m3u8"):
+            source = _variant_playlist(s3_key, bucket, work_dir)
+            demuxer_args = ["-protocol_whitelist", "file,http,https,tcp,tls,crypto"]
+        else:
+            source = tasks.get_presigned_url(s3_key, bucket, public=False)
+            if not source:
+                return []
+            # Fragmented MP4 (streaming transcodes) carries its seek index
+            # in the trailing mfra box; use it instead of walking fragments.
+            demuxer_args = ["-use_mfra_for", "pts"]
+
+        info = media.probe_source(source, demuxer_args)
+        duration = info.get("duration") or 0
+        positions = positions or sample_positions(count)
+
+        cmd = ["ffmpeg", "-nostdin", "-v", "error", "-y"]
+        for fraction in positions:
+            cmd += demuxer_args + [
+                "-ss", f"{duration * fraction:.3f}",
+                "-noaccurate_seek",
+                "-skip_frame", "nokey",
+                "-i", source,
+            ]
+        outputs = []
+        for i, fraction in enumerate(positions):
+            out = os.path.join(work_dir, f"frame_{i}.jpg")
+            outputs.append((fraction, out))
+            cmd += [
+                "-map", f"{i}:v:0", "-frames:v", "1",
+                "-vf", f"scale='min({width},iw)':-2",
+                "-q:v", "4", out,
+            ]
+        result = subprocess.run(cmd, capture_output=True, timeout=FRAME_SAMPLE_TIMEOUT)
+        if result.returncode != 0:
+            print(f"   Frame sampling for {s3_key} reported: {result.stderr.decode(errors='replace')[-300:]}")
+
+        frames = []
+        for fraction, out in outputs:
+            if os.path.exists(out) and os.path.getsize(out) > 0:
+                with open(out, "rb") as f:
+                    frames.append((fraction, f.read()))
+        return frames
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+
+def dhash(jpeg: bytes):
+    """
+    64-bit difference hash of an image: shrink to 9x8 grey, then one bit per
+    pixel for "brighter than its right neighbour". Near-identical frames
+    differ in only a few bits. Returns None if the image can't be decoded.
+    """
+    cmd = [
+        "ffmpeg", "-nostdin", "-v", "error",
+        "-f", "image2pipe", "-i", "pipe:0",
+        "-vf", "scale=9:8:flags=area,format=gray",
+        "-frames:v", "1", "-f", "rawvideo", "pipe:1",
+    ]
+    try:
+        pixels = subprocess.run(cmd, input=jpeg, capture_output=True, timeout=30).stdout
+    except Exception as e:
+        print(f"   Could not hash frame: {e}")
+        return None
+    if len(pixels) != 72:
+        return None
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
@@ -10,6 +10,9 @@ from sqlalchemy.exc import OperationalError
 from sqlalchemy import text
 import search
 import os
+import asyncio
+import metrics
+import notifications
 from ws_manager import manager
 
 # NOTE: Base.metadata.create_all is intentionally NOT called here at module
@@ -27,6 +30,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 app.include_router(users.router)
@@ -38,12 +42,16 @@ def root():
 
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: int):
-    await manager.connect(user_id, websocket)
+    connection = await manager.connect(user_id, websocket)
     try:
         while True:
+            # Anything from the client ("pong" included) proves the socket is alive.
             await websocket.receive_text()
+            connection.mark_alive()
     except WebSocketDisconnect:
-        manager.disconnect(user_id, websocket)
+        pass
+    finally:
+        manager.disconnect(connection)
 
 # Internal endpoint — only the worker service should call this.
 # Protected by a shared secret sent in the X-Internal-Token header.
@@ -58,17 +66,39 @@ async def notify_user(
         raise HTTPException(status_code=403, detail="Forbidden")
 
     print(f"Sending notification to User {notification.user_id}: {notification.status}")
-    await manager.send_personal_message(
+    # Goes through the bus so the user gets it whichever replica holds their socket.
+    await notifications.deliver(
+        notification.user_id,
         {
             "type": "video_update",
             "video_id": notification.video_id,
             "status": notification.status,
-            "msg": notification.message
-        },
-        notification.user_id
+            "msg": notification.message,
+            "progress": notification.progress,
+            "eta_seconds": notification.eta_seconds
+        }
     )
     return {"status": "sent"}
 
+@app.get("/internal/metrics")
+def get_metrics(x_internal_token: str = Header(default="")):
+    if INTERNAL_NOTIFY_SECRET and x_internal_token != INTERNAL_NOTIFY_SECRET:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return metrics.snapshot()
+
+@app.on_event("startup")
+async def start_notification_listener():
+    # Every API process subscribes, so pushes published anywhere reach local sockets.
+    app.state.notification_listener = asyncio.create_task(notifications.listen(manager))
+
+@app.on_event("startup")
+async def start_upload_sweep():
+    app.state.upload_sweep = asyncio.create_task(videos.sweep_direct_uploads())
+
+@app.on_event("shutdown")
+async def close_search_client():
+    await search.close_async_client()
+
 @app.on_event("startup")
 async def seed_database():
     from database import SessionLocal
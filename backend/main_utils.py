@@ -54,6 +54,21 @@ def create_refresh_token(data: dict):
     to_encode.update({"exp": expire, "type": "refresh"})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+# Short-lived token embedded in HLS playlist URLs. Players fetch playlists
+# without cookies, so this proves the /videos/play access check already passed.
+PLAYBACK_TOKEN_EXPIRE_MINUTES = 60
+
+def create_playback_token(video_id: str):
+    expire = datetime.utcnow() + timedelta(minutes=PLAYBACK_TOKEN_EXPIRE_MINUTES)
+    return jwt.encode({"vid": video_id, "type": "playback", "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
+
+def verify_playback_token(token: str, video_id: str) -> bool:
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return False
+    return payload.get("type") == "playback" and payload.get("vid") == video_id
+
 # [FIX: SEC-004] Structured JSON audit log for every admin action.
 # Written to stdout so Docker / log shippers capture it automatically.
 def log_admin_action(action: str, admin_id: int, admin_email: str, target: str, details: dict = None):
@@ -0,0 +1,61 @@
+"""
+ffprobe helpers shared by the worker and the AI pipeline.
+"""
+import json
+import subprocess
+
+PROBE_TIMEOUT = 60
+
+def probe_source(source: str, input_args=()) -> dict:
+    """
+    Probe a local path or (presigned) URL once and return the facts the
+    pipeline cares about. Missing streams come back as None. `input_args`
+    are demuxer options placed before the input.
+    """
+    cmd = [
+        "ffprobe", "-v", "error", *input_args,
+        "-show_entries",
+        "format=duration,format_name:stream=codec_type,codec_name,width,height,pix_fmt",
+        "-of", "json", source,
+    ]
+    result = subprocess.run(cmd, capture_output=True, check=True, timeout=PROBE_TIMEOUT)
+    data = json.loads(result.stdout or b"{}")
+
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+
+    try:
+        duration = float(data.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+
+    return {
+        "duration": duration,
+        "format_name": data.get("format", {}).get("format_name", ""),
+        "width": video.get("width") if video else None,
+        "height": video.get("height") if video else None,
+        "video_codec": video.get("codec_name") if video else None,
+        "pix_fmt": video.get("pix_fmt") if video else None,
+        "audio_codec": audio.get("codec_name") if audio else None,
+    }
+
+def keyframe_near(source: str, seconds: float):
+    """
+    Timestamp of the first video keyframe at the position ffprobe seeks to for
+    `seconds`. Only a few packets around that point are read, so this is cheap
+    even over HTTP. Returns None when no keyframe is found.
+    """
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-read_intervals", f"{seconds:.3f}%+#120",
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=p=0", source,
+    ]
+    result = subprocess.run(cmd, capture_output=True, check=True, timeout=PROBE_TIMEOUT)
+    for line in result.stdout.decode().splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags and pts not in ("", "N/A"):
+            return float(pts)
+    return None
@@ -0,0 +1,179 @@
+"""
+Lightweight counters, gauges and timings shared by the API and the workers.
+
+Values live in one Redis hash so every process (API replicas, workers)
+reports into the same place and GET /internal/metrics shows the whole
+system. If Redis is unavailable the values are kept in this process only.
+
+Timings are stored as count / sum / max plus cumulative buckets, which is
+enough to read averages and rough percentiles off the snapshot.
+
+incr(), gauge() and observe() talk to Redis inline. Hot paths on an event
+loop use the *_deferred() variants instead: they only add to an
+in-memory batch, which a background thread writes out every
+METRICS_FLUSH_INTERVAL seconds.
+"""
+import atexit
+import os
+import threading
+import time
+from cache import r
+
+METRICS_KEY = "metrics"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 1))
+
+_local = {}
+_lock = threading.Lock()
+
+# Deferred samples waiting for the next flush: field -> amount, the
+# largest duration seen per timing name, and the latest gauge values.
+_pending = {}
+_pending_max = {}
+_pending_gauges = {}
+_flusher = None
+
+def _local_incr(field, amount):
+    with _lock:
+        _local[field] = _local.get(field, 0) + amount
+
+def incr(name: str, amount: int = 1):
+    """Increase a counter."""
+    if r:
+        try:
+            r.hincrby(METRICS_KEY, name, amount)
+            return
+        except Exception:
+            pass
+    _local_incr(name, amount)
+
+def gauge(name: str, value: float):
+    """Record the latest value of something (queue depth, open sockets...)."""
+    if r:
+        try:
+            r.hset(METRICS_KEY, name, value)
+            return
+        except Exception:
+            pass
+    with _lock:
+        _local[name] = value
+
+def observe(name: str, seconds: float):
+    """Record one duration sample."""
+    buckets = [f"{name}:le_{b}" for b in LATENCY_BUCKETS if seconds <= b]
+    if r:
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.hincrby(METRICS_KEY, f"{name}:count", 1)
+            pipe.hincrbyfloat(METRICS_KEY, f"{name}:sum", seconds)
+            for field in buckets:
+                pipe.hincrby(METRICS_KEY, field, 1)
+            pipe.execute()
+            # Max is read-modify-write; being off by one concurrent sample is fine.
+            current_max = r.hget(METRICS_KEY, f"{name}:max")
+            if current_max is None or seconds > float(current_max):
+                r.hset(METRICS_KEY, f"{name}:max", seconds)
+            return
+        except Exception:
+            pass
+    with _lock:
+        _local[f"{name}:count"] = _local.get(f"{name}:count", 0) + 1
+        _local[f"{name}:sum"] = _local.get(f"{name}:sum", 0.0) + seconds
+        _local[f"{name}:max"] = max(_local.get(f"{name}:max", 0.0), seconds)
+        for field in buckets:
+            _local[field] = _local.get(field, 0) + 1
+
+def _start_flusher():
+    global _flusher
+    if _flusher is None:
+        _flusher = threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True)
+        _flusher.start()
+        atexit.register(flush)
+
+def incr_deferred(name: str, amount: int = 1):
+    """Like incr(), but never blocks: the count is written on the next flush."""
+    with _lock:
+        _pending[name] = _pending.get(name, 0) + amount
+        _start_flusher()
+
+def gauge_deferred(name: str, value: float):
+    """Like gauge(), but never blocks: the latest value is written on the next flush."""
+    with _lock:
+        _pending_gauges[name] = value
+        _start_flusher()
+
+def observe_deferred(name: str, seconds: float):
+    """Like observe(), but never blocks: the sample is written on the next flush."""
+    with _lock:
+        _pending[f"{name}:count"] = _pending.get(f"{name}:count", 0) + 1
+        _pending[f"{name}:sum"] = _pending.get(f"{name}:sum", 0.0) + seconds
+        for b in LATENCY_BUCKETS:
+            if seconds <= b:
+                field = f"{name}:le_{b}"
+                _pending[field] = _pending.get(field, 0) + 1
+        _pending_max[name] = max(_pending_max.get(name, 0.0), seconds)
+        _start_flusher()
+
+def flush():
+    """Write the deferred batch to Redis (or the local fallback) in one round trip."""
+    global _pending, _pending_max, _pending_gauges
+    with _lock:
+        pending, maxes, gauges = _pending, _pending_max, _pending_gauges
+        _pending, _pending_max, _pending_gauges = {}, {}, {}
+    if not pending and not gauges:
+        return
+    if r:
+        try:
+            pipe = r.pipeline(transaction=False)
+            for field, amount in pending.items():
+                if isinstance(amount, float):
+                    pipe.hincrbyfloat(METRICS_KEY, field, amount)
+                else:
+                    pipe.hincrby(METRICS_KEY, field, amount)
+            if gauges:
+                pipe.hset(METRICS_KEY, mapping=gauges)
+            for name in maxes:
+                pipe.hget(METRICS_KEY, f"{name}:max")
+            current = pipe.execute()[len(pending) + bool(gauges):]
+            higher = {f"{name}:max": value for (name, value), old in zip(maxes.items(), current)
+                      if old is None or value > float(old)}
+            if higher:
+                r.hset(METRICS_KEY, mapping=higher)
+            return
+        except Exception:
+            pass
+    with _lock:
+        for field, amount in pending.items():
+            _local[field] = _local.get(field, 0) + amount
+        for name, value in maxes.items():
+            _local[f"{name}:max"] = max(_local.get(f"{name}:max", 0.0), value)
+        _local.update(gauges)
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            print(f"⚠️ Metrics flush failed: {e}")
+
+def snapshot() -> dict:
+    """All metrics as a flat {name: number} dict."""
+    values = {}
+    if r:
+        try:
+            values = r.hgetall(METRICS_KEY)
+        except Exception:
+            values = {}
+    with _lock:
+        for field, value in _local.items():
+            values.setdefault(field, value)
+
+    result = {}
+    for field, value in sorted(values.items()):
+        try:
+            number = float(value)
+            result[field] = int(number) if number.is_integer() else number
+        except (TypeError, ValueError):
+            result[field] = value
+    return result
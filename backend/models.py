@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, Integer, ForeignKey, Boolean, BigInteger, Text
+from sqlalchemy import Column, String, DateTime, Integer, ForeignKey, Boolean, BigInteger, Text, Float
 from sqlalchemy.orm import relationship, backref
 from database import Base
 import datetime
@@ -27,9 +27,27 @@ class VideoJob(Base):
     filename = Column(String, nullable=False)
     file_size = Column(BigInteger, default=0)
     status = Column(String, default="pending")
+    resolution = Column(String, default="720p")
+    # Set while a direct-to-storage multipart upload is in progress.
+    upload_id = Column(String, nullable=True)
+    # Last time the client fetched part URLs for it; the session expires after
+    # DIRECT_UPLOAD_SESSION_TTL without activity.
+    upload_activity_at = Column(DateTime, nullable=True)
+    # Latest transcode progress (0-100) and estimated seconds left, written by the worker.
+    progress = Column(Integer, default=0)
+    eta_seconds = Column(Integer, nullable=True)
+    # sha256 of the uploaded bytes; jobs with the same hash + resolution share output.
+    content_hash = Column(String, index=True, nullable=True)
+    # Segmented transcodes: how many keyframe-aligned chunks exist / are encoded.
+    chunks_total = Column(Integer, default=0)
+    chunks_done = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     processed_at = Column(DateTime, nullable=True)
     s3_key = Column(String, nullable=True)
+    # Small JPEGs cut during transcoding: [{"at": 0.2, "key": "..."}] for the
+    # AI summarizer, plus a poster frame.
+    keyframe_keys = Column(Text, nullable=True)
+    poster_key = Column(String, nullable=True)
     is_deleted = Column(Boolean, default=False)
     owner_id = Column(Integer, ForeignKey("users.id"))
     owner = relationship("User", back_populates="videos")
@@ -39,6 +57,12 @@ class VideoJob(Base):
         uselist=False,
         cascade="all, delete-orphan"
     )
+    chunks = relationship(
+        "VideoChunk",
+        back_populates="video",
+        order_by="VideoChunk.chunk_index",
+        cascade="all, delete-orphan"
+    )
     @property
     def summary(self):
         if self.summary_data:
@@ -55,6 +79,19 @@ class VideoSummary(Base):
     video = relationship("VideoJob", back_populates="summary_data")
 
 
+class VideoChunk(Base):
+    """One keyframe-aligned slice of a video encoded independently of the others."""
+    __tablename__ = "video_chunks"
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(String, ForeignKey("video_jobs.id"), index=True, nullable=False)
+    chunk_index = Column(Integer, nullable=False)
+    start_time = Column(Float, nullable=False)
+    end_time = Column(Float, nullable=True)  # None = until the end of the source
+    status = Column(String, default="pending")
+    s3_key = Column(String, nullable=True)
+    video = relationship("VideoJob", back_populates="chunks")
+
+
 class RefreshToken(Base):
     """Stores hashed refresh tokens to allow server-side revocation."""
     __tablename__ = "refresh_tokens"
@@ -0,0 +1,68 @@
+"""
+Cross-process notification bus on Redis pub/sub.
+
+Workers, background tasks and any API replica publish messages for a user;
+every API process subscribes and delivers them to the WebSockets it holds
+locally. That way a push reaches the user no matter which process or
+replica their socket is attached to.
+"""
+import asyncio
+import json
+from cache import r, ar
+
+CHANNEL = "notifications"
+
+def _encode(user_id: int, message: dict) -> str:
+    return json.dumps({"user_id": user_id, "message": message})
+
+def publish(user_id: int, message: dict) -> bool:
+    """Publish from sync code. Returns False when Redis is unavailable."""
+    if not r:
+        return False
+    try:
+        r.publish(CHANNEL, _encode(user_id, message))
+        return True
+    except Exception as e:
+        print(f"[!] Notification publish failed: {e}")
+        return False
+
+async def publish_async(user_id: int, message: dict) -> bool:
+    """Publish from the event loop. Returns False when Redis is unavailable."""
+    try:
+        await ar.publish(CHANNEL, _encode(user_id, message))
+        return True
+    except Exception as e:
+        print(f"[!] Notification publish failed: {e}")
+        return False
+
+async def deliver(user_id: int, message: dict):
+    """Publish to every API process, or deliver locally if the bus is down."""
+    if not await publish_async(user_id, message):
+        from ws_manager import manager
+        await manager.send_personal_message(message, user_id)
+
+async def listen(manager):
+    """Runs for the life of the API process, relaying bus messages to local sockets."""
+    while True:
+        pubsub = ar.pubsub()
+        try:
+            await pubsub.subscribe(CHANNEL)
+            print("[bus] Subscribed to notifications")
+            async for item in pubsub.listen():
+                if item["type"] != "message":
+                    continue
+                try:
+                    data = json.loads(item["data"])
+                    await manager.send_personal_message(data["message"], data["user_id"])
+                except Exception as e:
+                    print(f"[!] Notification delivery failed: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[!] Notification bus disconnected: {e}; retrying in 2s")
+            await asyncio.sleep(2)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
@@ -0,0 +1,250 @@
+"""
+Async client for the Ollama generate API.
+
+One pooled httpx connection set is shared by every request in the process,
+and each model gets its own concurrency limit so a burst of vision calls
+can't starve the text model (or overload a GPU that only fits a couple of
+parallel requests). Transient failures (connection errors, timeouts, 429,
+5xx) are retried with exponential backoff and full jitter.
+
+ModelScheduler sits in front of the client and runs requests from every
+in-flight job in model-grouped batches, so a CPU-only Ollama host isn't
+made to swap models back and forth between the stages of each job.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+from collections import deque
+
+import httpx
+
+import metrics
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434/api/generate")
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", 16))
+OLLAMA_DEFAULT_CONCURRENCY = int(os.getenv("OLLAMA_DEFAULT_CONCURRENCY", 2))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", 5))
+OLLAMA_MAX_ATTEMPTS = int(os.getenv("OLLAMA_MAX_ATTEMPTS", 3))
+OLLAMA_RETRY_BASE_DELAY = float(os.getenv("OLLAMA_RETRY_BASE_DELAY", 0.5))
+OLLAMA_RETRY_MAX_DELAY = float(os.getenv("OLLAMA_RETRY_MAX_DELAY", 8))
+# How long Ollama keeps a model loaded after the last request.
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Requests served for one model before letting a waiting model have a turn.
+OLLAMA_MAX_BATCH = int(os.getenv("OLLAMA_MAX_BATCH", 32))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class OllamaError(Exception):
+    pass
+
+
+class OllamaClient:
+    def __init__(self, url: str = OLLAMA_URL, concurrency: dict = None):
+        self.url = url
+        self.concurrency = concurrency or {}
+        self._client = None
+        self._loop = None
+        self._semaphores = {}
+
+    def _ensure_loop_state(self):
+        # httpx clients and asyncio semaphores belong to one event loop.
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphores = {}
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=OLLAMA_MAX_CONNECTIONS,
+                    max_keepalive_connections=OLLAMA_MAX_CONNECTIONS,
+                ),
+            )
+
+    def _semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self._semaphores:
+            limit = self.concurrency.get(model, OLLAMA_DEFAULT_CONCURRENCY)
+            self._semaphores[model] = asyncio.Semaphore(max(1, limit))
+        return self._semaphores[model]
+
+    async def generate(self, model: str, prompt: str, images=None, timeout: float = 120, on_token=None, **extra) -> str:
+        """
+        Run one generation and return the response text. With `on_token`,
+        Ollama streams the answer and each chunk is passed to the callback
+        as it arrives; a stream that fails after emitting text is not
+        retried, since the caller has already shown part of it.
+        """
+        self._ensure_loop_state()
+        payload = {"model": model, "prompt": prompt, "stream": on_token is not None, **extra}
+        if images:
+            payload["images"] = images
+        request_timeout = httpx.Timeout(timeout, connect=OLLAMA_CONNECT_TIMEOUT)
+
+        for attempt in range(1, OLLAMA_MAX_ATTEMPTS + 1):
+            parts = []
+            try:
+                async with self._semaphore(model):
+                    started = time.monotonic()
+                    if on_token is None:
+                        response = await self._client.post(self.url, json=payload, timeout=request_timeout)
+                        self._check_status(model, response)
+                        text = response.json().get("response", "")
+                    else:
+                        async with self._client.stream("POST", self.url, json=payload, timeout=request_timeout) as response:
+                            self._check_status(model, response)
+                            async for line in response.aiter_lines():
+                                if not line:
+                                    continue
+                                data = json.loads(line)
+                                if data.get("error"):
+                                    raise OllamaError(data["error"])
+                                chunk = data.get("response", "")
+                                if chunk:
+                                    if not parts:
+                                        metrics.observe_deferred(f"ollama.{model}.first_token", time.monotonic() - started)
+                                    parts.append(chunk)
+                                    on_token(chunk)
+                                if data.get("done"):
+                                    break
+                        text = "".join(parts)
+                    metrics.observe_deferred(f"ollama.{model}.latency", time.monotonic() - started)
+                return text
+            except (httpx.TransportError, OllamaError) as e:
+                metrics.incr_deferred(f"ollama.{model}.errors")
+                if parts or attempt == OLLAMA_MAX_ATTEMPTS:
+                    raise OllamaError(f"{model} failed after {attempt} attempts: {e}") from e
+                delay = random.uniform(0, min(OLLAMA_RETRY_MAX_DELAY, OLLAMA_RETRY_BASE_DELAY * 2 ** attempt))
+                print(f"   {model} request failed ({e}); retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _check_status(model, response):
+        if response.status_code in RETRYABLE_STATUS:
+            raise OllamaError(f"{model} returned HTTP {response.status_code}")
+        response.raise_for_status()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._loop = None
+
+
+class _Request:
+    __slots__ = ("prompt", "images", "timeout", "on_token", "extra", "future", "enqueued_at")
+
+    def __init__(self, prompt, images, timeout, on_token, extra):
+        self.prompt = prompt
+        self.images = images
+        self.timeout = timeout
+        self.on_token = on_token
+        self.extra = extra
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+
+class ModelScheduler:
+    """
+    Queues generate() calls per model and serves one model at a time.
+
+    While a model is current, its pending requests run up to that model's
+    concurrency limit; newcomers for the same model join the batch until
+    OLLAMA_MAX_BATCH have been served. Then, if another model has requests
+    waiting, the scheduler lets the in-flight ones finish and switches to
+    the model that has waited longest. Every request carries keep_alive so
+    the current model stays warm between batches.
+
+    Scheduling covers one process; run a single ai_worker per Ollama host
+    (with higher AI_WORKER_CONCURRENCY) to get the full benefit.
+    """
+
+    def __init__(self, client: OllamaClient, keep_alive: str = OLLAMA_KEEP_ALIVE, max_batch: int = OLLAMA_MAX_BATCH):
+        self.client = client
+        self.keep_alive = keep_alive
+        self.max_batch = max_batch
+        self.current_model = None
+        self.swaps = 0
+        self._queues = {}
+        self._loop = None
+        self._wakeup = None
+        self._dispatcher = None
+
+    def _ensure_loop_state(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queues = {}
+            self._wakeup = asyncio.Event()
+            self._dispatcher = None
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+
+    async def generate(self, model: str, prompt: str, images=None, timeout: float = 120, on_token=None, **extra) -> str:
+        self._ensure_loop_state()
+        request = _Request(prompt, images, timeout, on_token, extra)
+        self._queues.setdefault(model, deque()).append(request)
+        self._report_depth(model)
+        self._wakeup.set()
+        return await request.future
+
+    def _report_depth(self, model):
+        metrics.gauge_deferred(f"ollama.queue_depth.{model}", len(self._queues.get(model, ())))
+
+    def _next_model(self):
+        waiting = {m: q for m, q in self._queues.items() if q}
+        if not waiting:
+            return None
+        others = [m for m in waiting if m != self.current_model]
+        if not others:
+            return self.current_model
+        return min(others, key=lambda m: waiting[m][0].enqueued_at)
+
+    async def _dispatch(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            model = self._next_model()
+            if model is None:
+                continue
+            if model != self.current_model:
+                if self.current_model is not None:
+                    self.swaps += 1
+                    metrics.incr_deferred("ollama.model_swaps")
+                    print(f"   [scheduler] {self.current_model} -> {model}")
+                self.current_model = model
+            await self._run_batch(model)
+            # Another model (or more of this one) may be waiting already.
+            self._wakeup.set()
+
+    async def _run_batch(self, model):
+        queue = self._queues[model]
+        limit = max(1, self.client.concurrency.get(model, OLLAMA_DEFAULT_CONCURRENCY))
+        running = set()
+        served = 0
+        while running or (queue and served < self.max_batch):
+            while queue and len(running) < limit and served < self.max_batch:
+                request = queue.popleft()
+                if request.future.done():  # caller gave up
+                    continue
+                served += 1
+                running.add(asyncio.create_task(self._run(model, request)))
+            self._report_depth(model)
+            if not running:
+                break
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        metrics.incr_deferred(f"ollama.batches.{model}")
+
+    async def _run(self, model, request):
+        metrics.observe_deferred(f"ollama.{model}.queue_wait", time.monotonic() - request.enqueued_at)
+        try:
+            result = await self.client.generate(
+                model, request.prompt, images=request.images, timeout=request.timeout,
+                on_token=request.on_token, keep_alive=self.keep_alive, **request.extra,
+            )
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
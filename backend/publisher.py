@@ -0,0 +1,195 @@
+"""
+Long-lived RabbitMQ publisher, one per process.
+
+pika connections are not thread-safe, so a single daemon thread owns the
+connection and publishes whatever callers put on its queue. Callers get a
+Future back: sync code can wait on it, async handlers await it without
+blocking the event loop.
+
+Messages that arrive together (or within PUBLISH_BATCH_WINDOW_MS, up to
+PUBLISH_BATCH_SIZE) are published as one AMQP transaction, so a batch
+costs a single broker round trip: pika's blocking channel waits for each
+publisher confirm in turn, while tx.commit covers the whole batch. A
+Future only resolves once the commit is acknowledged, i.e. the broker has
+taken responsibility for the message. Dropped connections are re-opened on
+the next flush and the affected batch is retried.
+"""
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import pika
+
+import metrics
+
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
+RABBITMQ_USER = os.getenv("RABBITMQ_USER", "guest")
+RABBITMQ_PASS = os.getenv("RABBITMQ_PASS", "guest")
+
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", 50))
+PUBLISH_BATCH_WINDOW_MS = int(os.getenv("PUBLISH_BATCH_WINDOW_MS", 0))
+PUBLISH_CONFIRM_TIMEOUT = float(os.getenv("PUBLISH_CONFIRM_TIMEOUT", 10))
+PUBLISH_MAX_ATTEMPTS = 3
+# How often the idle publisher thread services heartbeats on the connection.
+_IDLE_POLL_SECONDS = 5
+
+
+class _Message:
+    __slots__ = ("queue_name", "body", "future", "enqueued_at", "attempts")
+
+    def __init__(self, queue_name, body):
+        self.queue_name = queue_name
+        self.body = body
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class RabbitPublisher:
+    def __init__(self):
+        self._pending = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._connection = None
+        self._channel = None
+        self._declared = set()
+
+    # --- public API -----------------------------------------------------------
+
+    def publish(self, queue_name: str, message: dict) -> Future:
+        """Queue a persistent message for `queue_name`; the Future resolves once committed."""
+        self._ensure_thread()
+        msg = _Message(queue_name, json.dumps(message))
+        self._pending.put(msg)
+        return msg.future
+
+    def publish_and_wait(self, queue_name: str, message: dict, timeout: float = PUBLISH_CONFIRM_TIMEOUT):
+        return self.publish(queue_name, message).result(timeout=timeout)
+
+    async def publish_async(self, queue_name: str, message: dict, timeout: float = PUBLISH_CONFIRM_TIMEOUT):
+        future = self.publish(queue_name, message)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+
+    # --- publisher thread -----------------------------------------------------
+
+    def _ensure_thread(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="rabbit-publisher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                first = self._pending.get(timeout=_IDLE_POLL_SECONDS)
+            except queue.Empty:
+                self._keepalive()
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + PUBLISH_BATCH_WINDOW_MS / 1000
+            while len(batch) < PUBLISH_BATCH_SIZE:
+                try:
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0:
+                        batch.append(self._pending.get(timeout=remaining))
+                    else:
+                        batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            # published / flushes gives the average batch size.
+            metrics.incr_deferred("rabbitmq.flushes")
+            self._flush(batch)
+
+    def _flush(self, batch):
+        while batch:
+            try:
+                channel = self._get_channel()
+                for msg in batch:
+                    if msg.queue_name not in self._declared:
+                        channel.queue_declare(queue=msg.queue_name, durable=True)
+                        self._declared.add(msg.queue_name)
+                    channel.basic_publish(
+                        exchange='',
+                        routing_key=msg.queue_name,
+                        body=msg.body,
+                        properties=pika.BasicProperties(delivery_mode=2),
+                    )
+                # One round trip for the whole batch: commit-ok means the broker
+                # has taken every message in it.
+                channel.tx_commit()
+            except Exception as e:
+                metrics.incr_deferred("rabbitmq.publish_errors")
+                print(f"[!] RabbitMQ publish of {len(batch)} message(s) failed: {e}")
+                self._reset_connection()
+                retry = []
+                for msg in batch:
+                    msg.attempts += 1
+                    if msg.attempts >= PUBLISH_MAX_ATTEMPTS:
+                        metrics.incr_deferred("rabbitmq.publish_failed")
+                        msg.future.set_exception(e)
+                    else:
+                        retry.append(msg)
+                batch = retry
+                if batch:
+                    time.sleep(min(2 ** batch[0].attempts * 0.1, 2))
+                continue
+
+            now = time.monotonic()
+            for msg in batch:
+                metrics.incr_deferred("rabbitmq.published")
+                metrics.observe_deferred("rabbitmq.publish_latency", now - msg.enqueued_at)
+                msg.future.set_result(True)
+            return
+
+    def _get_channel(self):
+        if self._channel is not None and self._channel.is_open:
+            return self._channel
+        self._reset_connection()
+        credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+        self._connection = pika.BlockingConnection(
+            pika.ConnectionParameters(
+                host=RABBITMQ_HOST,
+                credentials=credentials,
+                heartbeat=60,
+                blocked_connection_timeout=PUBLISH_CONFIRM_TIMEOUT,
+            )
+        )
+        self._channel = self._connection.channel()
+        self._channel.tx_select()
+        metrics.incr_deferred("rabbitmq.connections_opened")
+        return self._channel
+
+    def _reset_connection(self):
+        if self._connection is not None:
+            try:
+                if self._connection.is_open:
+                    self._connection.close()
+            except Exception:
+                pass
+        self._connection = None
+        self._channel = None
+        self._declared.clear()
+
+    def _keepalive(self):
+        """Let pika answer broker heartbeats while no messages are flowing."""
+        if self._connection is None:
+            return
+        try:
+            self._connection.process_data_events(time_limit=0)
+        except Exception as e:
+            print(f"[!] RabbitMQ publisher connection lost: {e}")
+            metrics.incr_deferred("rabbitmq.connection_drops")
+            self._reset_connection()
+
+
+# Singleton shared across the entire process
+publisher = RabbitPublisher()
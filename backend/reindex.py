@@ -0,0 +1,33 @@
+"""
+Rebuild the Elasticsearch index from Postgres and swap the `videos` alias.
+
+Usage (from backend/, or `docker compose exec api python reindex.py`):
+    python reindex.py [--batch-size 1000] [--keep-old]
+"""
+import argparse
+
+from database import SessionLocal
+import search
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=search.REINDEX_BATCH_SIZE,
+                        help="rows fetched per cursor batch and documents per bulk request")
+    parser.add_argument("--keep-old", action="store_true",
+                        help="leave the previous index in place after the alias moves")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        result = search.reindex(db, batch_size=args.batch_size, keep_old=args.keep_old)
+    except search.IndexBusy as e:
+        raise SystemExit(str(e))
+    finally:
+        db.close()
+    if result["failed"] or result["suggestions_failed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
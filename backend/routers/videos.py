@@ -1,13 +1,18 @@
-from fastapi import APIRouter, BackgroundTasks, Depends, UploadFile, File, HTTPException, status, Form
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
+from sqlalchemy import func, desc, or_
 from typing import List, Optional
+import asyncio
+import datetime
+import hashlib
 import os
+import uuid
 import models, schemas, database, tasks, main_utils
 import search
 import cache
+import metrics
 from sqlalchemy.orm import joinedload
-import ai_utils
+from python_multipart.multipart import MultipartParser, parse_options_header
 
 router = APIRouter(prefix="/videos", tags=["Videos"])
 
@@ -19,6 +24,37 @@ ALLOWED_CONTENT_TYPES = {
 ALLOWED_EXTENSIONS = {".mp4", ".mpeg", ".mov", ".avi", ".mkv", ".webm", ".flv", ".3gp", ".wmv", ".ogv"}
 MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2 GB
 
+def _validate_video_type(filename: Optional[str], content_type: Optional[str]):
+    # Validate file type (both extension and content-type header)
+    file_ext = os.path.splitext(filename or "")[1].lower()
+    if file_ext not in ALLOWED_EXTENSIONS or content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid file type. Only video files are accepted (mp4, mov, avi, mkv, webm, etc.)"
+        )
+
+def _upload_allowance(db: Session, user: models.User, exclude_job_id: Optional[str] = None):
+    """Returns (max bytes this user may still upload, whether the quota is the binding limit)."""
+    if user.is_admin:
+        return MAX_FILE_SIZE, False
+    usage_query = db.query(func.sum(models.VideoJob.file_size)).filter(
+        models.VideoJob.owner_id == user.id,
+        models.VideoJob.is_deleted == False,
+        # Abandoned direct uploads stop reserving quota once they expire.
+        or_(models.VideoJob.status != "uploading", _upload_activity >= _upload_cutoff())
+    )
+    if exclude_job_id:
+        usage_query = usage_query.filter(models.VideoJob.id != exclude_job_id)
+    remaining = user.storage_limit - (usage_query.scalar() or 0)
+    if remaining < MAX_FILE_SIZE:
+        return max(remaining, 0), True
+    return MAX_FILE_SIZE, False
+
+def _upload_limit_error(quota_limited: bool) -> HTTPException:
+    if quota_limited:
+        return HTTPException(status_code=400, detail="Storage quota exceeded!")
+    return HTTPException(status_code=413, detail="File too large. Maximum allowed size is 2 GB.")
+
 @router.get("/feed", response_model=List[schemas.VideoOut])
 def get_video_feed(
     category: Optional[str] = None,
@@ -35,69 +71,425 @@ def get_video_feed(
         query = query.filter(models.VideoJob.category == category)
     return query.order_by(desc(models.VideoJob.created_at)).offset(skip).limit(limit).all()
 
+# Room for the small form fields and multipart framing around the file.
+UPLOAD_FORM_OVERHEAD = 1024 * 1024
+# Received file bytes are handed to the S3 writer in batches of about this size.
+UPLOAD_FLUSH_BYTES = 1024 * 1024
+UPLOAD_MAX_FIELD_SIZE = 64 * 1024
+
+class _UploadFormParser:
+    """
+    Incremental multipart/form-data parser for /videos/upload. Text fields
+    are collected into `fields`; the bytes of the single file part pile up
+    in `pending` for the caller to drain as they arrive.
+    """
+
+    def __init__(self, boundary: bytes):
+        self.fields = {}
+        self.filename = None
+        self.content_type = None
+        self.received = 0
+        self.pending = bytearray()
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._name = None
+        self._is_file = False
+        self._value = bytearray()
+        self._parser = MultipartParser(boundary, callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def write(self, data: bytes):
+        self._parser.write(data)
+
+    def finalize(self):
+        self._parser.finalize()
+
+    def _on_part_begin(self):
+        self._headers = {}
+        self._name = None
+        self._is_file = False
+        self._value = bytearray()
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field, self._header_value = b"", b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._name = options.get(b"name", b"").decode(errors="replace")
+        if b"filename" in options:
+            if self.filename is not None:
+                raise HTTPException(status_code=400, detail="Only one file can be uploaded at a time")
+            self._is_file = True
+            self.filename = options[b"filename"].decode(errors="replace")
+            self.content_type = self._headers.get(b"content-type", b"").decode(errors="replace") or None
+
+    def _on_part_data(self, data, start, end):
+        if self._is_file:
+            self.pending += data[start:end]
+            self.received += end - start
+        else:
+            self._value += data[start:end]
+            if len(self._value) > UPLOAD_MAX_FIELD_SIZE:
+                raise HTTPException(status_code=400, detail=f"Field '{self._name}' is too large")
+
+    def _on_part_end(self):
+        if not self._is_file:
+            self.fields[self._name] = self._value.decode(errors="replace")
+
+def _form_bool(value: Optional[str]) -> bool:
+    return (value or "").strip().lower() in ("1", "true", "on", "yes")
+
 @router.post("/upload", response_model=schemas.VideoOut)
 async def create_upload_job(
-    file: UploadFile = File(...),
-    title: str = Form(...),
-    description: str = Form(None),
-    category: str = Form("Other"),
-    is_shared: bool = Form(False),
-    resolution: str = Form("720p"),
+    request: Request,
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(main_utils.get_current_user)
 ):
-    # Validate file type (both extension and content-type header)
-    file_ext = os.path.splitext(file.filename or "")[1].lower()
-    if file_ext not in ALLOWED_EXTENSIONS or file.content_type not in ALLOWED_CONTENT_TYPES:
-        raise HTTPException(
-            status_code=400,
-            detail="Invalid file type. Only video files are accepted (mp4, mov, avi, mkv, webm, etc.)"
-        )
-
-    # Validate file size
-    file_size = file.size
-    if file_size is None:
-        # Read a chunk to get size if Content-Length not provided
-        content = await file.read()
-        file_size = len(content)
-        await file.seek(0)
-
-    if file_size > MAX_FILE_SIZE:
-        raise HTTPException(status_code=413, detail="File too large. Maximum allowed size is 2 GB.")
-
-    if not current_user.is_admin:
-        current_usage = db.query(func.sum(models.VideoJob.file_size)).filter(
-            models.VideoJob.owner_id == current_user.id,
-            models.VideoJob.is_deleted == False
-        ).scalar() or 0
-        if current_usage + file_size > current_user.storage_limit:
-            raise HTTPException(status_code=400, detail="Storage quota exceeded!")
-
+    """
+    Multipart upload (file, title, description, category, is_shared,
+    resolution). The body is parsed as it arrives: the size limits are
+    enforced on the bytes received so far and the file goes to an S3
+    multipart upload while the client is still sending it.
+    """
+    form_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if form_type != b"multipart/form-data" or not options.get(b"boundary"):
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+
+    max_bytes, quota_limited = _upload_allowance(db, current_user)
+    # Turn away anything that declares a body too large for the limit
+    # before reading it; the loop below still counts what actually arrives.
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > max_bytes + UPLOAD_FORM_OVERHEAD:
+        raise _upload_limit_error(quota_limited)
+
+    parser = _UploadFormParser(options[b"boundary"])
+    job_id = str(uuid.uuid4())
+    s3_filename = None
+    upload = None
+    # The content hash is computed on the same pass, off the event loop.
+    hasher = hashlib.sha256()
+
+    def consume(chunk: bytes):
+        hasher.update(chunk)
+        upload.write(chunk)
+
+    async def flush():
+        if parser.pending:
+            chunk = bytes(parser.pending)
+            parser.pending.clear()
+            await asyncio.to_thread(consume, chunk)
+
+    # S3 calls run in worker threads so the event loop keeps serving requests.
+    try:
+        async for data in request.stream():
+            parser.write(data)
+            if parser.received > max_bytes:
+                raise _upload_limit_error(quota_limited)
+            if upload is None and parser.filename is not None:
+                _validate_video_type(parser.filename, parser.content_type)
+                s3_filename = tasks.raw_object_key(current_user.id, job_id, parser.filename)
+                upload = tasks.MultipartUpload("raw-videos", s3_filename)
+            if upload is not None and len(parser.pending) >= UPLOAD_FLUSH_BYTES:
+                await flush()
+        parser.finalize()
+
+        if upload is None:
+            raise HTTPException(status_code=422, detail="A video file is required")
+        title = parser.fields.get("title")
+        if not title:
+            raise HTTPException(status_code=422, detail="A title is required")
+        await flush()
+        file_size = await asyncio.to_thread(upload.complete)
+    except BaseException:
+        if upload is not None:
+            await asyncio.to_thread(upload.abort)
+        raise
+
+    filename = parser.filename
+    description = parser.fields.get("description") or None
+    category = parser.fields.get("category") or "Other"
+    is_shared = _form_bool(parser.fields.get("is_shared"))
+    resolution = parser.fields.get("resolution") or "720p"
+
+    content_hash = hasher.hexdigest()
     new_job = models.VideoJob(
-        filename=file.filename,
+        id=job_id,
+        filename=filename,
         title=title,
         description=description,
         category=category,
         is_shared=is_shared,
         owner_id=current_user.id,
         status="pending",
-        file_size=file_size
+        resolution=resolution,
+        file_size=file_size,
+        content_hash=content_hash
     )
-    db.add(new_job)
-    db.commit()
 
-    if is_shared:
-        search.index_video(new_job.id, new_job.title, description, category)
+    # Same bytes already transcoded at this resolution: point at that output
+    # and skip the worker entirely.
+    original = db.query(models.VideoJob).filter(
+        models.VideoJob.content_hash == content_hash,
+        models.VideoJob.resolution == resolution,
+        models.VideoJob.status == "completed",
+        models.VideoJob.s3_key.isnot(None)
+    ).first()
+    if original:
+        new_job.status = "completed"
+        new_job.s3_key = original.s3_key
+        new_job.keyframe_keys = original.keyframe_keys
+        new_job.poster_key = original.poster_key
+        new_job.processed_at = datetime.datetime.utcnow()
 
+    db.add(new_job)
+    db.commit()
     db.refresh(new_job)
+    await search.index_video_async(new_job)
 
-    s3_filename = f"raw/user_{current_user.id}/{new_job.id}-{file.filename}"
-    await file.seek(0)
-    tasks.upload_to_s3(file.file, "raw-videos", s3_filename)
-    tasks.notify_worker(new_job.id, s3_filename, resolution)
+    if original:
+        metrics.incr("upload.dedup_hits")
+        print(f"[=] Upload {new_job.id} duplicates {original.id}; reusing {original.s3_key}")
+        try:
+            await asyncio.to_thread(tasks.S3_CLIENT.delete_object, Bucket="raw-videos", Key=s3_filename)
+        except Exception as e:
+            print(f"Could not delete duplicate raw upload: {e}")
+        return new_job
+
+    await tasks.notify_worker_async(new_job.id, s3_filename, resolution)
 
     return new_job
 
+# --- Direct-to-storage uploads ------------------------------------------------
+# The browser PUTs parts straight to S3 using presigned URLs, so upload bytes
+# never pass through the API. A session can be resumed at any time by asking
+# for it again: S3 is the source of truth for which parts have landed.
+
+DIRECT_UPLOAD_URL_EXPIRY = int(os.getenv("DIRECT_UPLOAD_URL_EXPIRY", 3600))
+# A session nobody has created, resumed or refreshed part URLs for in this
+# long is abandoned: it stops counting against the quota and the sweep
+# aborts its multipart upload. Measured from the last activity, not from
+# creation, so a slow upload that keeps resuming never runs out.
+DIRECT_UPLOAD_SESSION_TTL = int(os.getenv("DIRECT_UPLOAD_SESSION_TTL", 7 * 24 * 3600))
+DIRECT_UPLOAD_SWEEP_INTERVAL = int(os.getenv("DIRECT_UPLOAD_SWEEP_INTERVAL", 300))
+
+_upload_activity = func.coalesce(models.VideoJob.upload_activity_at, models.VideoJob.created_at)
+
+def _upload_cutoff() -> datetime.datetime:
+    return datetime.datetime.utcnow() - datetime.timedelta(seconds=DIRECT_UPLOAD_SESSION_TTL)
+
+def _session_seconds_left(job: models.VideoJob) -> int:
+    return int(((job.upload_activity_at or job.created_at) - _upload_cutoff()).total_seconds())
+
+def _get_upload_job(db: Session, job_id: str, user: models.User, allow_expired: bool = False) -> models.VideoJob:
+    job = db.query(models.VideoJob).filter(models.VideoJob.id == job_id).first()
+    if not job or job.owner_id != user.id:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    if job.status != "uploading" or not job.upload_id:
+        raise HTTPException(status_code=409, detail="Upload is already finished")
+    if not allow_expired and _session_seconds_left(job) <= 0:
+        raise HTTPException(status_code=410, detail="Upload session expired")
+    return job
+
+def expire_direct_uploads(db: Session) -> int:
+    """Abort and remove direct uploads left unfinished past their TTL; returns how many."""
+    stale = db.query(models.VideoJob).filter(
+        models.VideoJob.status == "uploading",
+        _upload_activity < _upload_cutoff()
+    ).with_for_update(skip_locked=True).limit(100).all()
+    for job in stale:
+        if job.upload_id:
+            tasks.abort_multipart_upload(tasks.raw_object_key(job.owner_id, job.id, job.filename), job.upload_id)
+        db.delete(job)
+    db.commit()
+    return len(stale)
+
+async def sweep_direct_uploads():
+    """Background loop started by the API; every process runs it, row locks keep them apart."""
+    while True:
+        await asyncio.sleep(DIRECT_UPLOAD_SWEEP_INTERVAL)
+        db = database.SessionLocal()
+        try:
+            expired = await asyncio.to_thread(expire_direct_uploads, db)
+            if expired:
+                metrics.incr("upload.direct_expired", expired)
+                print(f"[upload] Expired {expired} abandoned direct uploads")
+        except Exception as e:
+            print(f"[!] Direct upload sweep failed: {e}")
+        finally:
+            db.close()
+
+def _total_parts(file_size: int) -> int:
+    return max(1, -(-file_size // tasks.UPLOAD_PART_SIZE))
+
+async def _upload_session(db: Session, job: models.VideoJob) -> schemas.DirectUploadSession:
+    raw_key = tasks.raw_object_key(job.owner_id, job.id, job.filename)
+    uploaded = await asyncio.to_thread(tasks.list_uploaded_parts, raw_key, job.upload_id)
+    # Handing out part URLs (on create or resume) keeps the session alive.
+    job.upload_activity_at = datetime.datetime.utcnow()
+    db.commit()
+    done = {p["PartNumber"]: p for p in uploaded}
+
+    # URLs never outlive the session they belong to.
+    expires_in = max(1, min(DIRECT_UPLOAD_URL_EXPIRY, _session_seconds_left(job)))
+    completed, pending = [], []
+    for part_number in range(1, _total_parts(job.file_size) + 1):
+        if part_number in done:
+            completed.append(schemas.UploadPart(
+                part_number=part_number,
+                size=done[part_number]["Size"],
+                etag=done[part_number]["ETag"],
+            ))
+        else:
+            # Signing is local (no network call), so it is fine on the loop.
+            pending.append(schemas.UploadPart(
+                part_number=part_number,
+                url=tasks.get_presigned_part_url(
+                    raw_key, job.upload_id, part_number, expiration=expires_in
+                ),
+            ))
+
+    return schemas.DirectUploadSession(
+        job_id=job.id,
+        upload_id=job.upload_id,
+        part_size=tasks.UPLOAD_PART_SIZE,
+        total_parts=_total_parts(job.file_size),
+        expires_in=expires_in,
+        completed_parts=completed,
+        pending_parts=pending,
+    )
+
+@router.post("/uploads", response_model=schemas.DirectUploadSession)
+async def create_direct_upload(
+    payload: schemas.DirectUploadCreate,
+    db: Session = Depends(database.get_db),
+    current_user: models.User = Depends(main_utils.get_current_user)
+):
+    _validate_video_type(payload.filename, payload.content_type)
+    if payload.file_size <= 0:
+        raise HTTPException(status_code=400, detail="file_size must be positive")
+
+    max_bytes, quota_limited = _upload_allowance(db, current_user)
+    if payload.file_size > max_bytes:
+        raise _upload_limit_error(quota_limited)
+
+    # The declared size is stored up front so it reserves quota while the
+    # client uploads; /complete replaces it with the size S3 actually holds.
+    job = models.VideoJob(
+        filename=payload.filename,
+        title=payload.title,
+        description=payload.description,
+        category=payload.category,
+        is_shared=payload.is_shared,
+        owner_id=current_user.id,
+        status="uploading",
+        resolution=payload.resolution,
+        file_size=payload.file_size
+    )
+    db.add(job)
+    db.flush()
+
+    raw_key = tasks.raw_object_key(current_user.id, job.id, payload.filename)
+    try:
+        resp = await asyncio.to_thread(
+            tasks.S3_CLIENT.create_multipart_upload, Bucket="raw-videos", Key=raw_key
+        )
+    except Exception as e:
+        db.rollback()
+        print(f"Could not start multipart upload: {e}")
+        raise HTTPException(status_code=502, detail="Could not start upload")
+
+    job.upload_id = resp["UploadId"]
+    db.commit()
+    db.refresh(job)
+    return await _upload_session(db, job)
+
+@router.get("/uploads/{job_id}", response_model=schemas.DirectUploadSession)
+async def resume_direct_upload(
+    job_id: str,
+    db: Session = Depends(database.get_db),
+    current_user: models.User = Depends(main_utils.get_current_user)
+):
+    """Returns the parts S3 has confirmed plus fresh URLs for everything still missing."""
+    job = _get_upload_job(db, job_id, current_user)
+    return await _upload_session(db, job)
+
+@router.post("/uploads/{job_id}/complete", response_model=schemas.VideoOut)
+async def complete_direct_upload(
+    job_id: str,
+    db: Session = Depends(database.get_db),
+    current_user: models.User = Depends(main_utils.get_current_user)
+):
+    job = _get_upload_job(db, job_id, current_user)
+    raw_key = tasks.raw_object_key(job.owner_id, job.id, job.filename)
+
+    # ETags come from S3 itself rather than the client, so a client cannot
+    # stitch in parts it never uploaded.
+    parts = await asyncio.to_thread(tasks.list_uploaded_parts, raw_key, job.upload_id)
+    total_parts = _total_parts(job.file_size)
+    if [p["PartNumber"] for p in parts] != list(range(1, total_parts + 1)):
+        raise HTTPException(status_code=409, detail="Upload is missing parts")
+
+    uploaded_size = sum(p["Size"] for p in parts)
+    max_bytes, quota_limited = _upload_allowance(db, current_user, exclude_job_id=job.id)
+    if uploaded_size > job.file_size:
+        raise HTTPException(status_code=400, detail="Uploaded data is larger than the declared file size")
+    if uploaded_size > max_bytes:
+        raise _upload_limit_error(quota_limited)
+
+    try:
+        await asyncio.to_thread(
+            tasks.S3_CLIENT.complete_multipart_upload,
+            Bucket="raw-videos",
+            Key=raw_key,
+            UploadId=job.upload_id,
+            MultipartUpload={"Parts": [
+                {"PartNumber": p["PartNumber"], "ETag": p["ETag"]} for p in parts
+            ]},
+        )
+    except Exception as e:
+        print(f"Could not complete multipart upload {job.id}: {e}")
+        raise HTTPException(status_code=502, detail="Could not finalise upload")
+
+    job.upload_id = None
+    job.file_size = uploaded_size
+    job.status = "pending"
+    db.commit()
+    db.refresh(job)
+    await search.index_video_async(job)
+    # The bytes never passed through here, so content-hash dedup happens in
+    # the worker, which hashes the raw object before transcoding it.
+    await tasks.notify_worker_async(job.id, raw_key, job.resolution or "720p")
+    return job
+
+@router.delete("/uploads/{job_id}")
+async def abort_direct_upload(
+    job_id: str,
+    db: Session = Depends(database.get_db),
+    current_user: models.User = Depends(main_utils.get_current_user)
+):
+    job = _get_upload_job(db, job_id, current_user, allow_expired=True)
+    raw_key = tasks.raw_object_key(job.owner_id, job.id, job.filename)
+    await asyncio.to_thread(tasks.abort_multipart_upload, raw_key, job.upload_id)
+
+    db.delete(job)
+    db.commit()
+    return {"message": "Upload cancelled"}
+
 @router.get("/my-videos", response_model=List[schemas.VideoOut])
 async def list_videos(
     db: Session = Depends(database.get_db),
@@ -114,6 +506,13 @@ async def get_job_status(job_id: str, db: Session = Depends(database.get_db)):
     if not job: raise HTTPException(status_code=404, detail="Job not found")
     return job
 
+def _processed_output_refs(db: Session, s3_key: str, exclude_job_id: str) -> int:
+    """How many other jobs point at the same processed output."""
+    return db.query(func.count(models.VideoJob.id)).filter(
+        models.VideoJob.s3_key == s3_key,
+        models.VideoJob.id != exclude_job_id
+    ).scalar()
+
 @router.delete("/{video_id}")
 async def delete_video(
     video_id: str,
@@ -127,59 +526,89 @@ async def delete_video(
     if not current_user.is_admin and video.owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized")
 
+    if video.status == "uploading":
+        # An unfinished direct upload has nothing worth keeping in the trash;
+        # drop its parts along with the row.
+        if video.upload_id:
+            raw_key = tasks.raw_object_key(video.owner_id, video.id, video.filename)
+            await asyncio.to_thread(tasks.abort_multipart_upload, raw_key, video.upload_id)
+        db.delete(video)
+        db.commit()
+        return {"message": "Upload cancelled"}
+
     if current_user.is_admin:
         try:
             from tasks import S3_CLIENT
-            raw_path = f"raw/user_{video.owner_id}/{video.id}-{video.filename}"
+            raw_path = tasks.raw_object_key(video.owner_id, video.id, video.filename)
             S3_CLIENT.delete_object(Bucket="raw-videos", Key=raw_path)
-            if video.s3_key:
-                S3_CLIENT.delete_object(Bucket="processed-videos", Key=video.s3_key)
+            # Deduplicated uploads share one processed output; only remove it
+            # when this is the last job referencing it.
+            if video.s3_key and _processed_output_refs(db, video.s3_key, video.id) == 0:
+                tasks.delete_processed_output(video.s3_key)
         except Exception as e:
             print(f"S3 Purge failed: {e}")
 
         db.delete(video)
         db.commit()
+        await search.delete_video_async(video_id)
         return {"message": "Admin: Video purged permanently"}
     else:
         video.is_deleted = True
         db.commit()
+        await search.update_video_async(video_id, is_deleted=True)
         return {"message": "Video moved to trash"}
 
 @router.get("/search", response_model=List[schemas.VideoOut])
-def search_public_videos(
+async def search_public_videos(
+    response: Response,
     q: Optional[str] = None,
     category: Optional[str] = None,
-    db: Session = Depends(database.get_db)
+    sort: str = "relevance",
+    cursor: Optional[str] = None,
+    limit: int = search.SEARCH_PAGE_SIZE,
 ):
-    query = db.query(models.VideoJob).options(
-        joinedload(models.VideoJob.summary_data)
-    ).filter(
-        models.VideoJob.is_shared == True,
-        models.VideoJob.is_deleted == False
-    )
-
-    if category and category != "All":
-        query = query.filter(models.VideoJob.category == category)
-
-    if q:
-        # Limit search query length to prevent abuse
-        q = q[:200]
-        try:
-            video_ids = search.search_videos(q, None)
-        except Exception as e:
-            print(f"Search failed: {e}")
-            video_ids = []
-
-        if not video_ids:
-            return []
-
-        query = query.filter(models.VideoJob.id.in_(video_ids))
+    """
+    Public search, answered from the index alone. Results come in relevance
+    (or newest-first with sort=date) order; when there are more, the cursor
+    for the next page is returned in the X-Next-Cursor header.
+    """
+    if sort not in search.SORTS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of: {', '.join(search.SORTS)}")
+    limit = max(1, min(limit, search.SEARCH_MAX_PAGE_SIZE))
+    # Limit search query length to prevent abuse
+    q = q[:200] if q else None
+
+    try:
+        videos, next_cursor = await search.search_videos(q, category, sort=sort, cursor=cursor, size=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Search failed: {e}")
+        raise HTTPException(
+            status_code=503, detail="Search is temporarily unavailable",
+            headers={"Retry-After": str(int(search.ES_BREAKER_COOLDOWN))},
+        )
 
-    return query.order_by(models.VideoJob.created_at.desc()).all()
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return videos
+
+@router.get("/suggest", response_model=List[schemas.VideoSuggestion])
+async def suggest_videos(q: str, category: Optional[str] = None, limit: int = search.SUGGEST_SIZE):
+    """As-you-type title suggestions for public videos; best effort, empty when search is down."""
+    q = q.strip()[:50]
+    if not q:
+        return []
+    try:
+        return await search.suggest_titles(q, category, size=max(1, min(limit, search.SUGGEST_MAX_SIZE)))
+    except Exception as e:
+        print(f"Suggest failed: {e}")
+        return []
 
 @router.get("/play/{video_id}")
 async def get_video_url(
     video_id: str,
+    request: Request,
     db: Session = Depends(database.get_db),
     current_user: Optional[models.User] = Depends(main_utils.get_current_user_optional)
 ):
@@ -195,11 +624,69 @@ async def get_video_url(
     if not video.s3_key:
         raise HTTPException(status_code=400, detail="Video is not ready yet")
 
+    if video.s3_key.endswith(".m3u8"):
+        # Segments sit in a private bucket, so playlists are served through the
+        # API with every segment URL presigned. The token stands in for the
+        # auth check above, since HLS players fetch playlists without cookies.
+        token = main_utils.create_playback_token(video.id)
+        manifest = request.url_for("get_hls_playlist", video_id=video.id, playlist="master.m3u8")
+        return {"url": f"{manifest}?token={token}", "format": "hls"}
+
     url = tasks.get_presigned_url(video.s3_key, "processed-videos")
     if not url:
         raise HTTPException(status_code=500, detail="Could not generate playback link")
 
-    return {"url": url}
+    return {"url": url, "format": "mp4"}
+
+@router.get("/hls/{video_id}/{playlist}", name="get_hls_playlist")
+async def get_hls_playlist(
+    video_id: str,
+    playlist: str,
+    request: Request,
+    token: str,
+    db: Session = Depends(database.get_db)
+):
+    if not main_utils.verify_playback_token(token, video_id):
+        raise HTTPException(status_code=403, detail="Invalid or expired playback token")
+    if not playlist.endswith(".m3u8") or "/" in playlist or playlist.startswith("."):
+        raise HTTPException(status_code=404, detail="Playlist not found")
+
+    video = db.query(models.VideoJob).filter(models.VideoJob.id == video_id).first()
+    if not video or not video.s3_key or not video.s3_key.endswith(".m3u8"):
+        raise HTTPException(status_code=404, detail="Playlist not found")
+
+    hls_prefix = video.s3_key.rsplit("/", 1)[0] + "/"
+    try:
+        obj = await asyncio.to_thread(
+            tasks.S3_CLIENT.get_object, Bucket="processed-videos", Key=hls_prefix + playlist
+        )
+        body = await asyncio.to_thread(obj["Body"].read)
+    except Exception as e:
+        print(f"Could not load playlist {playlist} for {video_id}: {e}")
+        raise HTTPException(status_code=404, detail="Playlist not found")
+
+    def resolve(uri: str) -> str:
+        if uri.endswith(".m3u8"):
+            # Variant playlists are rewritten by this same endpoint.
+            variant = request.url_for("get_hls_playlist", video_id=video_id, playlist=uri)
+            return f"{variant}?token={token}"
+        return tasks.get_presigned_url(hls_prefix + uri, "processed-videos") or uri
+
+    lines = []
+    for line in body.decode().splitlines():
+        if line.startswith("#EXT-X-MAP:") and 'URI="' in line:
+            head, rest = line.split('URI="', 1)
+            uri, tail = rest.split('"', 1)
+            line = f'{head}URI="{resolve(uri)}"{tail}'
+        elif line and not line.startswith("#"):
+            line = resolve(line)
+        lines.append(line)
+
+    return Response(
+        content="\n".join(lines) + "\n",
+        media_type="application/vnd.apple.mpegurl",
+        headers={"Cache-Control": "private, max-age=60"},
+    )
 
 @router.get("/admin/all", response_model=List[schemas.VideoOut])
 async def get_all_videos_admin(
@@ -239,7 +726,6 @@ async def get_all_videos_admin(
 async def generate_video_summary(
     video_id: str,
     force: bool = False,
-    background_tasks: BackgroundTasks = None,
     db: Session = Depends(database.get_db),
     current_user: models.User = Depends(main_utils.get_current_user)
 ):
@@ -271,7 +757,18 @@ async def generate_video_summary(
             cache.set_cached_summary(video_id, db_summary.summary_text)
             return {"summary": db_summary.summary_text, "status": "ready"}
 
-    # Run AI pipeline as a background task so this endpoint returns immediately.
-    # The result is pushed to the user via WebSocket (type: "summary_ready").
-    background_tasks.add_task(ai_utils.generate_summary_background, video_id, current_user.id)
+    # Single-flight: if a generation is already running for this video, just
+    # join its waiters; they all get the same summary_ready push. force takes
+    # the lock over with a new token, so the older run discards its result.
+    token = uuid.uuid4().hex
+    if not cache.acquire_summary_lock(video_id, current_user.id, token, force=force):
+        return {"summary": None, "status": "generating"}
+
+    # The AI worker picks the job up from its queue so this endpoint returns
+    # immediately. The result is pushed to the user via WebSocket (type: "summary_ready").
+    try:
+        await tasks.notify_ai_worker_async(video_id, current_user.id, token, force=force)
+    except Exception:
+        cache.release_summary_lock(video_id, token)
+        raise
     return {"summary": None, "status": "generating"}
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 class UserCreate(BaseModel):
@@ -30,10 +30,44 @@ class VideoOut(BaseModel):
     is_deleted: bool
     owner_email: Optional[str] = None
     summary: Optional[str] = None
+    chunks_total: Optional[int] = None
+    chunks_done: Optional[int] = None
+    progress: Optional[int] = None
+    eta_seconds: Optional[int] = None
 
     class Config:
         from_attributes = True
 
+class VideoSuggestion(BaseModel):
+    id: str
+    title: Optional[str] = None
+    category: Optional[str] = None
+
+class DirectUploadCreate(BaseModel):
+    filename: str
+    content_type: str
+    file_size: int
+    title: str
+    description: Optional[str] = None
+    category: Optional[str] = "Other"
+    is_shared: bool = False
+    resolution: str = "720p"
+
+class UploadPart(BaseModel):
+    part_number: int
+    size: Optional[int] = None
+    etag: Optional[str] = None
+    url: Optional[str] = None
+
+class DirectUploadSession(BaseModel):
+    job_id: str
+    upload_id: str
+    part_size: int
+    total_parts: int
+    expires_in: int
+    completed_parts: List[UploadPart]
+    pending_parts: List[UploadPart]
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -42,4 +76,6 @@ class NotifySchema(BaseModel):
     user_id: int
     message: str
     video_id: str
-    status: str
\ No newline at end of file
+    status: str
+    progress: Optional[int] = None
+    eta_seconds: Optional[int] = None
\ No newline at end of file
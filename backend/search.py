@@ -1,80 +1,547 @@
-from elasticsearch import Elasticsearch, AsyncElasticsearch
+from contextlib import contextmanager
+from elasticsearch import Elasticsearch, AsyncElasticsearch, ApiError, NotFoundError, TransportError, helpers
+from sqlalchemy.orm import joinedload
+import asyncio
+import base64
+import json
 import os
+import time
+import uuid
+
+import cache
+import metrics
+import models
+from database import SessionLocal
 
 ES_URL = os.getenv("ELASTICSEARCH_URL", "http://elasticsearch:9200")
-es = Elasticsearch(ES_URL)
+# Searches sit on the request path, so they get a tight budget; writes a bit more.
+ES_SEARCH_TIMEOUT = float(os.getenv("ES_SEARCH_TIMEOUT", 2))
+ES_WRITE_TIMEOUT = float(os.getenv("ES_WRITE_TIMEOUT", 5))
+ES_BULK_TIMEOUT = float(os.getenv("ES_BULK_TIMEOUT", 60))
+ES_MAX_CONNECTIONS = int(os.getenv("ES_MAX_CONNECTIONS", 20))
+# Consecutive failures before calls fail fast, and for how long.
+ES_BREAKER_THRESHOLD = int(os.getenv("ES_BREAKER_THRESHOLD", 5))
+ES_BREAKER_COOLDOWN = float(os.getenv("ES_BREAKER_COOLDOWN", 30))
+
+# Blocking client for writes from sync code paths, startup and reindex.
+es = Elasticsearch(ES_URL, request_timeout=ES_WRITE_TIMEOUT, max_retries=1)
+_aes = None
+_aes_loop = None
+
+
+def async_client() -> AsyncElasticsearch:
+    """Pooled async client for searches; its connections belong to one event loop."""
+    global _aes, _aes_loop
+    loop = asyncio.get_running_loop()
+    if _aes is None or _aes_loop is not loop:
+        _aes_loop = loop
+        _aes = AsyncElasticsearch(
+            ES_URL, request_timeout=ES_SEARCH_TIMEOUT, connections_per_node=ES_MAX_CONNECTIONS, max_retries=0,
+        )
+    return _aes
+
+
+async def close_async_client():
+    global _aes, _aes_loop
+    if _aes is not None:
+        await _aes.close()
+        _aes, _aes_loop = None, None
+
+
+class SearchUnavailable(Exception):
+    pass
+
+
+def _is_outage(error) -> bool:
+    """Connection errors, timeouts, overload and 5xx count against the breaker; bad requests don't."""
+    if isinstance(error, TransportError):
+        return True
+    return isinstance(error, ApiError) and (error.meta.status == 429 or error.meta.status >= 500)
+
+
+class CircuitBreaker:
+    """
+    Fails fast while Elasticsearch is down instead of letting every caller
+    wait out its timeout. After `threshold` consecutive outage errors the
+    breaker opens for `cooldown` seconds; then a single trial call is let
+    through and its outcome closes or re-opens it.
+    """
+
+    def __init__(self, name: str, threshold: int = ES_BREAKER_THRESHOLD, cooldown: float = ES_BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def _before(self):
+        if self.opened_at is None:
+            return
+        if self._trial or time.monotonic() - self.opened_at < self.cooldown:
+            metrics.incr_deferred(f"search.{self.name}.rejected")
+            raise SearchUnavailable(f"Elasticsearch {self.name} circuit is open")
+        self._trial = True
+
+    def _success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def _failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                metrics.incr_deferred(f"search.{self.name}.opened")
+                print(f"[!] Elasticsearch {self.name} circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+    @contextmanager
+    def guard(self):
+        self._before()
+        try:
+            yield
+        except Exception as e:
+            if _is_outage(e):
+                self._failure()
+            else:
+                self._success()
+            raise
+        except BaseException:
+            # Cancelled (client went away): no verdict on Elasticsearch, but a
+            # half-open trial must not stay claimed or the breaker never closes.
+            self._trial = False
+            raise
+        self._success()
+
 
+search_breaker = CircuitBreaker("search")
+write_breaker = CircuitBreaker("write")
+
+# Readers and writers always go through this alias; the index behind it is
+# versioned (videos_<timestamp>) so a full rebuild can be swapped in atomically.
 INDEX_NAME = "videos"
+REINDEX_BATCH_SIZE = int(os.getenv("REINDEX_BATCH_SIZE", 1000))
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 20))
+SEARCH_MAX_PAGE_SIZE = 100
+# Typeahead entries for public videos live in their own small index.
+SUGGEST_INDEX = "video_suggest"
+ES_SUGGEST_TIMEOUT = float(os.getenv("ES_SUGGEST_TIMEOUT", 0.5))
+SUGGEST_SIZE = 8
+SUGGEST_MAX_SIZE = 20
+# Completion matches prefixes, so each title is also indexed from its later
+# words ("minecraft" should find "Let's play Minecraft").
+SUGGEST_MAX_INPUTS = 6
+# Document fields that decide whether (and how) a video is suggested.
+SUGGEST_FIELDS = {"title", "category", "is_shared", "is_deleted"}
+# What /videos/search may hand back (and cache). An include list, so fields
+# that are only for filtering, or left over in an older index, stay private.
+PUBLIC_FIELDS = [
+    "id", "filename", "title", "description", "summary", "category",
+    "is_shared", "is_deleted", "status", "s3_key", "created_at", "owner_id",
+    "file_size", "chunks_total", "chunks_done", "progress", "eta_seconds",
+]
+
+MAPPINGS = {
+    "properties": {
+        "id": {"type": "keyword"},
+        "filename": {"type": "keyword", "index": False},
+        "title": {"type": "text"},
+        "description": {"type": "text"},
+        "summary": {"type": "text"},
+        "category": {"type": "keyword"},
+        "is_shared": {"type": "boolean"},
+        "is_deleted": {"type": "boolean"},
+        "status": {"type": "keyword"},
+        "s3_key": {"type": "keyword", "index": False},
+        "created_at": {"type": "date"},
+        "owner_id": {"type": "integer"},
+        "file_size": {"type": "long"},
+        "chunks_total": {"type": "integer"},
+        "chunks_done": {"type": "integer"},
+        "progress": {"type": "integer"},
+        "eta_seconds": {"type": "integer"},
+    }
+}
+
+# Completion fields with contexts must be queried with one, so every
+# suggestion also carries this catch-all category for unfiltered lookups.
+SUGGEST_ALL_CONTEXT = "_all"
+# Bumped when suggestion documents change shape; create_index rebuilds an
+# index with an older version.
+SUGGEST_SCHEMA_VERSION = 2
+
+SUGGEST_MAPPINGS = {
+    "_meta": {"schema_version": SUGGEST_SCHEMA_VERSION},
+    "properties": {
+        "id": {"type": "keyword", "index": False},
+        "title": {"type": "keyword", "index": False},
+        "category": {"type": "keyword", "index": False},
+        "suggest": {
+            "type": "completion",
+            "contexts": [{"name": "category", "type": "category"}],
+        },
+    }
+}
+
+def _new_index_name(alias: str = INDEX_NAME):
+    return f"{alias}_{time.strftime('%Y%m%d%H%M%S')}"
+
+class IndexBusy(Exception):
+    pass
+
+@contextmanager
+def _index_lock():
+    """Hold the cluster-wide lock for index setup and rebuilds; yields the token."""
+    token = str(uuid.uuid4())
+    if not cache.acquire_search_index_lock(token):
+        raise IndexBusy("Another process is creating or rebuilding the search indices")
+    try:
+        yield token
+    finally:
+        cache.release_search_index_lock(token)
+
+def _suggest_index_current() -> bool:
+    """Whether the suggestion alias exists and points at the current document shape."""
+    if not es.indices.exists_alias(name=SUGGEST_INDEX):
+        return False
+    mappings = es.indices.get_mapping(index=SUGGEST_INDEX)
+    return all(
+        m["mappings"].get("_meta", {}).get("schema_version") == SUGGEST_SCHEMA_VERSION
+        for m in mappings.values()
+    )
 
 def create_index():
-    """Create the index if it doesn't exist"""
-    if not es.indices.exists(index=INDEX_NAME):
-        es.indices.create(index=INDEX_NAME, body={
-            "mappings": {
-                "properties": {
-                    "title": {"type": "text"},
-                    "description": {"type": "text"},
-                    "category": {"type": "keyword"},
-                    "created_at": {"type": "date"},
-                    "owner_id": {"type": "integer"}
-                }
-            }
-        })
-        print("✅ Elasticsearch Index Created!")
-
-def index_video(video_id: str, title: str, description: str, category: str):
-    """Save a video into the search engine"""
-    doc = {
-        "title": title,
-        "description": description,
-        "category": category,
-        "id": video_id
+    """Create versioned indices behind the search and suggestion aliases if they are missing or out of date"""
+    if es.indices.exists_alias(name=INDEX_NAME) and _suggest_index_current():
+        return
+    try:
+        with _index_lock() as token:
+            # Checked again under the lock: another process may have just finished.
+            have_videos = es.indices.exists_alias(name=INDEX_NAME)
+            have_suggest = _suggest_index_current()
+            if have_videos and have_suggest:
+                return
+            if have_videos or es.indices.exists(index=INDEX_NAME) or es.indices.exists_alias(name=SUGGEST_INDEX):
+                # Older deployments have a concrete "videos" index holding only shared
+                # videos' titles, or no (or an outdated) suggestion index; rebuild both
+                # from Postgres.
+                print("[search] Search indices are out of date; rebuilding them from Postgres")
+                db = SessionLocal()
+                try:
+                    _reindex(db, token)
+                finally:
+                    db.close()
+                return
+            name = _new_index_name()
+            es.indices.create(index=name, mappings=MAPPINGS, aliases={INDEX_NAME: {}})
+            es.indices.create(index=_new_index_name(SUGGEST_INDEX), mappings=SUGGEST_MAPPINGS, aliases={SUGGEST_INDEX: {}})
+            print(f"✅ Elasticsearch Index Created! ({name})")
+    except IndexBusy:
+        print("[search] Another process is setting up the search indices")
+
+def video_document(video) -> dict:
+    """The search document for a VideoJob: the VideoOut fields (minus the owner's email) plus the AI summary."""
+    return {
+        "id": video.id,
+        "filename": video.filename,
+        "title": video.title,
+        "description": video.description,
+        "summary": video.summary,
+        "category": video.category,
+        "is_shared": bool(video.is_shared),
+        "is_deleted": bool(video.is_deleted),
+        "status": video.status,
+        "s3_key": video.s3_key,
+        "created_at": video.created_at.isoformat() if video.created_at else None,
+        "owner_id": video.owner_id,
+        "file_size": video.file_size,
+        "chunks_total": video.chunks_total,
+        "chunks_done": video.chunks_done,
+        "progress": video.progress,
+        "eta_seconds": video.eta_seconds,
+    }
+
+def suggestion_document(doc: dict):
+    """Typeahead entry for a search document, or None if the video shouldn't be suggested."""
+    words = (doc.get("title") or "").split()
+    if not words or not doc.get("is_shared") or doc.get("is_deleted"):
+        return None
+    return {
+        "id": doc["id"],
+        "title": doc["title"],
+        "category": doc.get("category"),
+        "suggest": {
+            "input": [" ".join(words[i:]) for i in range(min(len(words), SUGGEST_MAX_INPUTS))],
+            "contexts": {"category": [doc.get("category") or "Other", SUGGEST_ALL_CONTEXT]},
+        },
     }
+
+def _sync_suggestion(video_id: str, doc: dict):
+    suggestion = suggestion_document(doc)
+    with write_breaker.guard():
+        if suggestion:
+            es.index(index=SUGGEST_INDEX, id=video_id, document=suggestion)
+        else:
+            try:
+                es.delete(index=SUGGEST_INDEX, id=video_id)
+            except NotFoundError:
+                pass
+
+def index_document(video_id: str, doc: dict):
+    """Save (or replace) a prepared search document"""
     try:
-        es.index(index=INDEX_NAME, id=video_id, document=doc)
+        with write_breaker.guard():
+            es.index(index=INDEX_NAME, id=video_id, document=doc)
+        _sync_suggestion(video_id, doc)
         print(f"[🔎] Indexed video {video_id}")
     except Exception as e:
         print(f"[!] ES Indexing failed: {e}")
+    cache.bump_search_generation()
+
+def index_video(video):
+    """Save (or replace) a video in the search engine"""
+    index_document(video.id, video_document(video))
 
-def update_video(video_id: str, title: str, description: str, category: str):
-    """Update an existing video document in the search index."""
+def update_video(video_id: str, **fields):
+    """Partially update an existing video document in the search index."""
     try:
-        es.update(index=INDEX_NAME, id=video_id, doc={
-            "title": title,
-            "description": description,
-            "category": category,
-        })
+        with write_breaker.guard():
+            res = es.update(index=INDEX_NAME, id=video_id, doc=fields, source=bool(SUGGEST_FIELDS & fields.keys()))
+        if "get" in res:
+            _sync_suggestion(video_id, res["get"]["_source"])
         print(f"[search] Updated video {video_id}")
     except Exception as e:
         print(f"[!] ES update failed: {e}")
+    cache.bump_search_generation()
+
+def delete_video(video_id: str):
+    """Remove a purged video from the search index."""
+    try:
+        for index in (INDEX_NAME, SUGGEST_INDEX):
+            try:
+                with write_breaker.guard():
+                    es.delete(index=index, id=video_id)
+            except NotFoundError:
+                pass
+        print(f"[search] Deleted video {video_id}")
+    except Exception as e:
+        print(f"[!] ES delete failed: {e}")
+    cache.bump_search_generation()
+
+# Async handlers and the AI worker's loop must not wait on ES inline. The
+# document is built on the caller's thread (where its ORM session lives)
+# and the blocking writes run in a worker thread.
+async def index_video_async(video):
+    await asyncio.to_thread(index_document, video.id, video_document(video))
+
+async def update_video_async(video_id: str, **fields):
+    await asyncio.to_thread(update_video, video_id, **fields)
+
+async def delete_video_async(video_id: str):
+    await asyncio.to_thread(delete_video, video_id)
+
+def _bulk_actions(db, index: str, suggest_index: str, batch_size: int):
+    query = db.query(models.VideoJob).options(
+        joinedload(models.VideoJob.summary_data),
+    ).execution_options(stream_results=True).yield_per(batch_size)
+    for video in query:
+        doc = video_document(video)
+        yield {"_index": index, "_id": video.id, "_source": doc}
+        suggestion = suggestion_document(doc)
+        if suggestion:
+            yield {"_index": suggest_index, "_id": video.id, "_source": suggestion}
+
+def _alias_targets(alias: str):
+    try:
+        return list(es.indices.get_alias(name=alias))
+    except NotFoundError:
+        return []
+
+def reindex(db, batch_size: int = REINDEX_BATCH_SIZE, keep_old: bool = False) -> dict:
+    """
+    Rebuild the search index from Postgres.
+
+    Rows are streamed with a server-side cursor (`batch_size` at a time,
+    summaries joined in the same query) and written with the
+    bulk helper into fresh versioned search and suggestion indices, with
+    refresh and replicas off while loading. Both aliases are then moved in
+    one update_aliases call, so searches never see a half-built index.
+    Writes that land on the old index while a rebuild is running are not
+    carried over; run it again (or in a quiet period) if that matters.
+    Raises IndexBusy if another rebuild holds the lock.
+    """
+    with _index_lock() as token:
+        return _reindex(db, token, batch_size, keep_old)
+
+def _reindex(db, token: str, batch_size: int = REINDEX_BATCH_SIZE, keep_old: bool = False) -> dict:
+    client = es.options(request_timeout=ES_BULK_TIMEOUT)
+    loading = {"refresh_interval": "-1", "number_of_replicas": 0}
+    name = _new_index_name()
+    suggest_name = _new_index_name(SUGGEST_INDEX)
+    client.indices.create(index=name, mappings=MAPPINGS, settings=loading)
+    client.indices.create(index=suggest_name, mappings=SUGGEST_MAPPINGS, settings=loading)
+
+    started = time.monotonic()
+    # Per target index: [written, failed]. Each video also yields a suggestion
+    # document, so the two are counted apart.
+    counts = {name: [0, 0], suggest_name: [0, 0]}
+    for ok, item in helpers.streaming_bulk(
+        client, _bulk_actions(db, name, suggest_name, batch_size),
+        chunk_size=batch_size, max_retries=3, raise_on_error=False,
+    ):
+        target = item["index"].get("_index")
+        counts.setdefault(target, [0, 0])[0 if ok else 1] += 1
+        if not ok:
+            print(f"[!] Bulk index failed: {item}")
+        written = sum(sum(c) for c in counts.values())
+        if written % (batch_size * 10) == 0:
+            print(f"[search] {written} documents written...")
+            cache.extend_search_index_lock(token)
+    indexed, failed = counts[name]
+    suggestions, suggestions_failed = counts[suggest_name]
+
+    for index in (name, suggest_name):
+        client.indices.put_settings(index=index, settings={"refresh_interval": None, "number_of_replicas": None})
+        client.indices.refresh(index=index)
+
+    old_indices = _alias_targets(INDEX_NAME)
+    old_suggest = _alias_targets(SUGGEST_INDEX)
+    actions = [
+        {"add": {"index": name, "alias": INDEX_NAME}},
+        {"add": {"index": suggest_name, "alias": SUGGEST_INDEX}},
+    ]
+    actions += [{"remove": {"index": old, "alias": INDEX_NAME}} for old in old_indices]
+    actions += [{"remove": {"index": old, "alias": SUGGEST_INDEX}} for old in old_suggest]
+    if not old_indices and es.indices.exists(index=INDEX_NAME):
+        # A concrete "videos" index is in the alias's way; drop it in the same step.
+        actions.append({"remove_index": {"index": INDEX_NAME}})
+    es.indices.update_aliases(actions=actions)
+    cache.bump_search_generation()
+
+    if not keep_old:
+        for old in old_indices + old_suggest:
+            es.indices.delete(index=old)
+
+    took = time.monotonic() - started
+    print(f"[search] Reindexed {indexed} videos into {name} ({failed} failed) and {suggestions} "
+          f"suggestions into {suggest_name} ({suggestions_failed} failed) in {took:.1f}s")
+    return {
+        "index": name, "indexed": indexed, "failed": failed,
+        "suggest_index": suggest_name, "suggestions": suggestions, "suggestions_failed": suggestions_failed,
+        "seconds": round(took, 1),
+    }
+
+SORTS = {
+    # `id` breaks ties so search_after never skips or repeats a hit.
+    "relevance": [{"_score": "desc"}, {"created_at": "desc"}, {"id": "asc"}],
+    "date": [{"created_at": "desc"}, {"id": "asc"}],
+}
+
+def encode_cursor(sort: str, values) -> str:
+    raw = json.dumps({"sort": sort, "after": values}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(sort: str, cursor: str):
+    """The search_after values in `cursor`; ValueError if it is malformed or from another sort."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        after = data["after"]
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError("Invalid cursor") from e
+    if data.get("sort") != sort or not isinstance(after, list) or len(after) != len(SORTS[sort]):
+        raise ValueError("Cursor does not match this sort")
+    return after
+
+async def search_videos(query: str = None, category: str = None, sort: str = "relevance",
+                  cursor: str = None, size: int = SEARCH_PAGE_SIZE):
+    """
+    One page of public videos, served from the indexed documents (or from
+    the Redis page cache while nothing has been written to the index since).
+    Raises SearchUnavailable without calling ES while the breaker is open.
+
+    Returns (documents, next_cursor); next_cursor is None on the last page.
+    Without a query every hit scores the same, so relevance falls back to
+    newest first.
+    """
+    if sort not in SORTS:
+        raise ValueError(f"Unknown sort '{sort}'")
 
-def search_videos(query: str = None, category: str = None):
-    """Search for videos with fuzzy matching"""
     must_clauses = []
 
     if query:
         must_clauses.append({
             "multi_match": {
                 "query": query,
-                "fields": ["title^3", "description"], 
-                "fuzziness": "AUTO" 
+                "fields": ["title^3", "description", "summary"],
+                "fuzziness": "AUTO"
             }
         })
-    
+
+    filter_clauses = [
+        {"term": {"is_shared": True}},
+        {"term": {"is_deleted": False}},
+    ]
     if category and category != "All":
-        must_clauses.append({"term": {"category": category}})
+        filter_clauses.append({"term": {"category": category}})
 
     body = {
         "query": {
             "bool": {
-                "must": must_clauses
+                "must": must_clauses or [{"match_all": {}}],
+                "filter": filter_clauses,
             }
-        }
+        },
+        "sort": SORTS[sort],
+        "size": size,
+        "_source": PUBLIC_FIELDS,
+        "track_total_hits": False,
+    }
+    if cursor:
+        body["search_after"] = decode_cursor(sort, cursor)
+
+    key = cache.search_cache_key(query, category, sort, cursor, size)
+    page, gen = await cache.get_search_page(key)
+    if page is not None:
+        metrics.incr_deferred("search.cache.hits")
+        return page["videos"], page["next_cursor"]
+    metrics.incr_deferred("search.cache.misses")
+
+    started = time.monotonic()
+    with search_breaker.guard():
+        res = await async_client().search(index=INDEX_NAME, body=body)
+    metrics.observe_deferred("search.latency", time.monotonic() - started)
+    hits = res["hits"]["hits"]
+
+    next_cursor = None
+    if len(hits) == size:
+        next_cursor = encode_cursor(sort, hits[-1]["sort"])
+    videos = [hit["_source"] for hit in hits]
+    if gen is not None:
+        await cache.set_search_page(key, gen, {"videos": videos, "next_cursor": next_cursor})
+    return videos, next_cursor
+
+async def suggest_titles(prefix: str, category: str = None, size: int = SUGGEST_SIZE):
+    """Public videos whose title (or a later part of it) starts with `prefix`, as {id, title, category}."""
+    completion = {
+        "field": "suggest",
+        "size": size,
+        "skip_duplicates": True,
+        "fuzzy": {"fuzziness": "AUTO"},
+    }
+    if category and category != "All":
+        completion["contexts"] = {"category": [category]}
+    else:
+        completion["contexts"] = {"category": [SUGGEST_ALL_CONTEXT]}
+    body = {
+        "size": 0,
+        "_source": ["id", "title", "category"],
+        "suggest": {"titles": {"prefix": prefix, "completion": completion}},
     }
-    
-    if not must_clauses:
-        body = {"query": {"match_all": {}}}
 
-    res = es.search(index=INDEX_NAME, body=body, size=50)
-    
-    return [hit["_id"] for hit in res["hits"]["hits"]]
\ No newline at end of file
+    started = time.monotonic()
+    with search_breaker.guard():
+        res = await async_client().options(request_timeout=ES_SUGGEST_TIMEOUT).search(index=SUGGEST_INDEX, body=body)
+    metrics.observe_deferred("search.suggest.latency", time.monotonic() - started)
+    return [option["_source"] for option in res["suggest"]["titles"][0]["options"]]
@@ -1,7 +1,8 @@
 import boto3
-import pika
 import os
-import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from publisher import publisher
 
 S3_CLIENT = boto3.client(
     's3',
@@ -10,49 +11,213 @@ S3_CLIENT = boto3.client(
     aws_secret_access_key=os.getenv("S3_SECRET_KEY", "minioadmin")
 )
 
+# Multipart tuning — S3 requires every part except the last to be >= 5 MB.
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE", 8 * 1024 * 1024))
+UPLOAD_MAX_IN_FLIGHT = int(os.getenv("UPLOAD_MAX_IN_FLIGHT", 4))
+
+def raw_object_key(owner_id, job_id, filename):
+    return f"raw/user_{owner_id}/{job_id}-{filename}"
+
+def processed_output_prefix(s3_key):
+    """
+    Folder holding everything derived from one transcode. MP4 outputs live at
+    processed/user_X/{job_id}.mp4 with sidecars under processed/user_X/{job_id}/;
+    HLS outputs are processed/user_X/{job_id}/hls/master.m3u8.
+    """
+    if "/hls/" in s3_key:
+        return s3_key.rsplit("/hls/", 1)[0] + "/"
+    return os.path.splitext(s3_key)[0] + "/"
+
+def delete_processed_output(s3_key, bucket="processed-videos"):
+    """Delete a processed video and every object under its output prefix."""
+    S3_CLIENT.delete_object(Bucket=bucket, Key=s3_key)
+    paginator = S3_CLIENT.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=processed_output_prefix(s3_key)):
+        keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        if keys:
+            S3_CLIENT.delete_objects(Bucket=bucket, Delete={"Objects": keys, "Quiet": True})
+
 def upload_to_s3(file_obj, bucket, object_name):
     S3_CLIENT.upload_fileobj(file_obj, bucket, object_name)
     return object_name
 
-def notify_worker(job_id, filename, resolution="720p"):
-    rabbitmq_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
-    rabbitmq_user = os.getenv("RABBITMQ_USER", "guest")
-    rabbitmq_pass = os.getenv("RABBITMQ_PASS", "guest")
-    credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_pass)
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host=rabbitmq_host, credentials=credentials)
-    )
-    channel = connection.channel()
 
-    QUEUE_NAME = 'video_tasks'
-    channel.queue_declare(queue=QUEUE_NAME, durable=True)
+class MultipartUpload:
+    """
+    Streams bytes into an S3 object without holding the whole file.
+
+    write() buffers until a full part is available and hands it to a small
+    thread pool; at most `max_in_flight` parts are buffered or uploading at
+    once, so memory stays around part_size * (max_in_flight + 1).
+    Objects smaller than one part are sent with a single put_object.
+    """
+
+    def __init__(self, bucket, key, part_size=UPLOAD_PART_SIZE, max_in_flight=UPLOAD_MAX_IN_FLIGHT):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._pool = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            chunk = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit(chunk)
+
+    def _submit(self, chunk):
+        self._raise_failed_part()
+        if self._upload_id is None:
+            resp = S3_CLIENT.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self._upload_id = resp["UploadId"]
+        part_number = len(self._futures) + 1
+        # Blocks the writer while max_in_flight parts are pending (backpressure).
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(self._upload_part, part_number, chunk)
+        except Exception:
+            self._slots.release()
+            raise
+        self._futures.append(future)
+
+    def _upload_part(self, part_number, chunk):
+        try:
+            resp = S3_CLIENT.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                PartNumber=part_number,
+                Body=chunk,
+            )
+            return {"PartNumber": part_number, "ETag": resp["ETag"]}
+        finally:
+            self._slots.release()
+
+    def _raise_failed_part(self):
+        for future in self._futures:
+            if future.done() and future.exception():
+                raise future.exception()
+
+    def complete(self):
+        """Flush the remaining buffer and finalise the object. Returns the byte count."""
+        try:
+            if self._upload_id is None:
+                S3_CLIENT.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                parts = [future.result() for future in self._futures]
+                S3_CLIENT.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+            self._buffer = bytearray()
+            return self.bytes_written
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def abort(self):
+        """Drop everything uploaded so far. Safe to call more than once."""
+        for future in self._futures:
+            future.cancel()
+        self._pool.shutdown(wait=True)
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            try:
+                S3_CLIENT.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            except Exception as e:
+                print(f"[!] Multipart abort failed for {self.key}: {e}")
+            self._upload_id = None
 
-    message = json.dumps({
+def abort_multipart_upload(key, upload_id, bucket="raw-videos"):
+    """Drop the parts of an unfinished multipart upload; failures are only logged."""
+    try:
+        S3_CLIENT.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    except Exception as e:
+        print(f"[!] Multipart abort failed for {key}: {e}")
+
+VIDEO_QUEUE = 'video_tasks'
+
+def _job_message(job_id, filename, resolution):
+    return {
         "job_id": job_id,
         "filename": filename,
         "resolution": resolution
-    })
+    }
 
-    channel.basic_publish(
-        exchange='',
-        routing_key=QUEUE_NAME,
-        body=message,
-        properties=pika.BasicProperties(delivery_mode=2)
-    )
-    connection.close()
+def notify_worker(job_id, filename, resolution="720p"):
+    """Queue a transcode job and wait for the broker to confirm it."""
+    publisher.publish_and_wait(VIDEO_QUEUE, _job_message(job_id, filename, resolution))
+
+async def notify_worker_async(job_id, filename, resolution="720p"):
+    """Same as notify_worker, for async handlers — never blocks the event loop."""
+    await publisher.publish_async(VIDEO_QUEUE, _job_message(job_id, filename, resolution))
 
-def get_presigned_url(object_name, bucket="processed-videos", expiration=3600):
-    """Generate a presigned URL for an S3 object — valid for 1 hour by default."""
+AI_QUEUE = 'ai_tasks'
+
+async def notify_ai_worker_async(video_id, user_id, token=None, force=False):
+    """
+    Queue an AI summary job; the result reaches the user as a summary_ready push.
+    `token` identifies the run holding the video's single-flight lock; `force`
+    makes the job ignore any cached or saved summary.
+    """
+    await publisher.publish_async(AI_QUEUE, {"video_id": video_id, "user_id": user_id, "token": token, "force": force})
+
+def _public_url(url):
+    """Rewrite the internal Docker hostname in a presigned URL to the externally accessible address."""
+    s3_internal = os.getenv("S3_ENDPOINT", "http://minio:9000").replace("http://", "").replace("https://", "")
+    s3_public = os.getenv("S3_PUBLIC_URL", "http://localhost:9000").replace("http://", "").replace("https://", "")
+    return url.replace(s3_internal, s3_public)
+
+def get_presigned_url(object_name, bucket="processed-videos", expiration=3600, public=True):
+    """
+    Generate a presigned URL for an S3 object — valid for 1 hour by default.
+    Pass public=False for URLs consumed inside the Docker network (e.g. ffmpeg in a worker).
+    """
     try:
         response = S3_CLIENT.generate_presigned_url(
             'get_object',
             Params={'Bucket': bucket, 'Key': object_name},
             ExpiresIn=expiration
         )
-        # Rewrite internal Docker hostname to the externally accessible address
-        s3_internal = os.getenv("S3_ENDPOINT", "http://minio:9000").replace("http://", "").replace("https://", "")
-        s3_public = os.getenv("S3_PUBLIC_URL", "http://localhost:9000").replace("http://", "").replace("https://", "")
-        return response.replace(s3_internal, s3_public)
+        return _public_url(response) if public else response
     except Exception as e:
         print(f"Error generating presigned URL: {e}")
         return None
+
+def get_presigned_part_url(object_name, upload_id, part_number, bucket="raw-videos", expiration=3600):
+    """Presigned PUT URL for one part of a multipart upload (browser → S3 directly)."""
+    response = S3_CLIENT.generate_presigned_url(
+        'upload_part',
+        Params={
+            'Bucket': bucket,
+            'Key': object_name,
+            'UploadId': upload_id,
+            'PartNumber': part_number,
+        },
+        ExpiresIn=expiration
+    )
+    return _public_url(response)
+
+def list_uploaded_parts(object_name, upload_id, bucket="raw-videos"):
+    """All parts S3 has confirmed for a multipart upload, ordered by part number."""
+    parts = []
+    marker = 0
+    while True:
+        resp = S3_CLIENT.list_parts(
+            Bucket=bucket, Key=object_name, UploadId=upload_id, PartNumberMarker=marker
+        )
+        parts.extend(resp.get("Parts", []))
+        if not resp.get("IsTruncated"):
+            break
+        marker = resp["NextPartNumberMarker"]
+    return sorted(parts, key=lambda p: p["PartNumber"])
@@ -1,18 +1,89 @@
 import pika
+import functools
+import hashlib
 import json
+import multiprocessing
 import os
+import shutil
 import subprocess
+import threading
 import requests
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import text
 from database import SessionLocal
-from models import VideoJob
-from tasks import S3_CLIENT
+from models import VideoJob, VideoChunk
+from tasks import S3_CLIENT, MultipartUpload, get_presigned_url, delete_processed_output, VIDEO_QUEUE
+from media import probe_source, keyframe_near
+import frames
+from publisher import publisher
+import metrics
+import notifications
+import search
 import datetime
 import time
 
 API_URL = os.getenv("INTERNAL_API_URL", "http://api:8002/internal/notify")
 INTERNAL_NOTIFY_SECRET = os.getenv("INTERNAL_NOTIFY_SECRET", "")
 
-def send_notification(user_id, video_id, status, message):
+# "file":   download to /tmp, transcode to /tmp, upload (the original flow,
+#           a regular MP4 with the moov atom up front).
+# "stream": ffmpeg reads the raw object over HTTP and its fragmented-MP4
+#           output is piped straight into a multipart upload — no temp files.
+#           Opt-in: fragmented MP4 seeks and downloads differently in some players.
+TRANSCODE_MODE = os.getenv("TRANSCODE_MODE", "file")
+# Long enough for ffmpeg to keep (re)opening the source during slow encodes.
+SOURCE_URL_EXPIRY = int(os.getenv("SOURCE_URL_EXPIRY", 6 * 3600))
+PIPE_READ_SIZE = 1024 * 1024
+
+# "mp4": one progressive MP4 at the resolution picked at upload.
+# "hls": the source is decoded once and every rung of ABR_LADDER is encoded
+#        in the same ffmpeg run into fMP4 (CMAF) HLS segments + master playlist.
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "mp4")
+ABR_LADDER = [int(h) for h in os.getenv("ABR_LADDER", "1080,720,480").split(",")]
+HLS_SEGMENT_SECONDS = int(os.getenv("HLS_SEGMENT_SECONDS", 4))
+# Target video bitrate (kbps) per rung height.
+ABR_BITRATES = {1080: 5000, 720: 2800, 480: 1400, 360: 800}
+# Segmented transcoding (mp4 output only):
+# "off":         one ffmpeg per video (default).
+# "local":       split at keyframes, encode chunks in parallel on this worker.
+# "distributed": split at keyframes, publish each chunk to video_tasks so idle
+#                workers pick them up; whoever finishes the last chunk stitches.
+SEGMENTED_TRANSCODE = os.getenv("SEGMENTED_TRANSCODE", "off")
+SEGMENT_COUNT = int(os.getenv("SEGMENT_COUNT", os.cpu_count() or 2))
+# Videos shorter than two of these are never split.
+SEGMENT_MIN_SECONDS = float(os.getenv("SEGMENT_MIN_SECONDS", 60))
+# Jobs run in a process pool so one container can use a whole host.
+# "auto" sizes the pool from cores, free /tmp space and memory; an integer
+# pins it. Each extra job is only started while the host still has room.
+WORKER_CONCURRENCY = os.getenv("WORKER_CONCURRENCY", "1")
+CORES_PER_JOB = float(os.getenv("CORES_PER_JOB", 2))
+DISK_PER_JOB_MB = int(os.getenv("DISK_PER_JOB_MB", 512 if TRANSCODE_MODE == "stream" else 4096))
+MEM_PER_JOB_MB = int(os.getenv("MEM_PER_JOB_MB", 1024))
+ADMISSION_RETRY_SECONDS = 5
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", 1.0))
+PROGRESS_MIN_STEP = int(os.getenv("PROGRESS_MIN_STEP", 5))
+HLS_CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".m4s": "video/iso.segment",
+    ".mp4": "video/mp4",
+}
+
+def send_notification(user_id, video_id, status, message, progress=None, eta_seconds=None):
+    # Published on the Redis bus; every API process delivers to its own sockets.
+    sent = notifications.publish(user_id, {
+        "type": "video_update",
+        "video_id": video_id,
+        "status": status,
+        "msg": message,
+        "progress": progress,
+        "eta_seconds": eta_seconds
+    })
+    if sent:
+        return
+
+    # Fallback when Redis is down: hand it to one API process over HTTP.
     try:
         headers = {}
         if INTERNAL_NOTIFY_SECRET:
@@ -21,12 +92,669 @@ def send_notification(user_id, video_id, status, message):
             "user_id": user_id,
             "video_id": video_id,
             "status": status,
-            "message": message
+            "message": message,
+            "progress": progress,
+            "eta_seconds": eta_seconds
         }
         requests.post(API_URL, json=payload, headers=headers, timeout=5)
     except Exception as e:
         print(f"[!] Notification failed: {e}")
 
+# --- Progress ------------------------------------------------------------------
+
+def store_progress(job_id, owner_id, percent, eta_seconds=None):
+    """Persist the latest progress (cheap for /status pollers) and push it to the user."""
+    db = SessionLocal()
+    try:
+        db.execute(
+            text("UPDATE video_jobs SET progress = :p, eta_seconds = :eta WHERE id = :id"),
+            {"p": percent, "eta": eta_seconds, "id": job_id},
+        )
+        db.commit()
+    finally:
+        db.close()
+    eta_text = f", ~{eta_seconds}s left" if eta_seconds is not None else ""
+    send_notification(owner_id, job_id, "processing", f"{percent}% done{eta_text}", percent, eta_seconds)
+
+class ProgressReporter:
+    """
+    Turns ffmpeg's -progress key=value stream into coalesced updates: at most
+    one every PROGRESS_MIN_INTERVAL seconds, unless the job jumped by
+    PROGRESS_MIN_STEP percent or more since the last update.
+    """
+
+    def __init__(self, job_id, owner_id, duration):
+        self.job_id = job_id
+        self.owner_id = owner_id
+        self.duration = duration
+        self.started_at = time.monotonic()
+        self.last_percent = 0
+        self.last_sent_at = 0.0
+
+    def consume(self, stream):
+        out_time = 0.0
+        for line in stream:
+            key, _, value = line.strip().partition("=")
+            if key == "out_time_us" and value.isdigit():
+                out_time = int(value) / 1_000_000
+            elif key == "progress":
+                # Never report 100 here — the job is done only once uploaded.
+                self.update(min(out_time / self.duration, 0.99) if self.duration else 0)
+        stream.close()
+
+    def update(self, fraction):
+        percent = int(fraction * 100)
+        now = time.monotonic()
+        if percent <= self.last_percent:
+            return
+        if now - self.last_sent_at < PROGRESS_MIN_INTERVAL and percent - self.last_percent < PROGRESS_MIN_STEP:
+            return
+        elapsed = now - self.started_at
+        eta = int(elapsed * (1 - fraction) / fraction) if fraction > 0 else None
+        self.last_percent, self.last_sent_at = percent, now
+        try:
+            store_progress(self.job_id, self.owner_id, percent, eta)
+        except Exception as e:
+            print(f"[!] Progress update failed: {e}")
+
+def _spawn_ffmpeg(cmd, reporter=None, stdout=None):
+    """Start ffmpeg; with a reporter, its -progress output goes to a private pipe."""
+    if reporter is None or not reporter.duration:
+        return subprocess.Popen(cmd, stdout=stdout)
+    read_fd, write_fd = os.pipe()
+    cmd = [cmd[0], "-progress", f"pipe:{write_fd}", "-nostats"] + cmd[1:]
+    try:
+        proc = subprocess.Popen(cmd, stdout=stdout, pass_fds=(write_fd,))
+    finally:
+        os.close(write_fd)
+    threading.Thread(target=reporter.consume, args=(os.fdopen(read_fd),), daemon=True).start()
+    return proc
+
+def _run_ffmpeg(cmd, reporter=None):
+    proc = _spawn_ffmpeg(cmd, reporter)
+    try:
+        returncode = proc.wait()
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, "ffmpeg")
+
+def _open_source(input_filename, local_input):
+    """Returns what ffmpeg should read: a presigned URL (stream mode) or a downloaded file."""
+    if TRANSCODE_MODE == "stream":
+        return get_presigned_url(
+            input_filename, "raw-videos", expiration=SOURCE_URL_EXPIRY, public=False
+        )
+    S3_CLIENT.download_file("raw-videos", input_filename, local_input)
+    return local_input
+
+def _input_args(source):
+    if source.startswith(("http://", "https://")):
+        return ["-reconnect", "1", "-reconnect_delay_max", "10", "-i", source]
+    return ["-i", source]
+
+def _video_args(target_h):
+    return [
+        "-vf", f"scale=-2:{target_h}",
+        "-c:v", "libx264", "-crf", "23", "-preset", "veryfast",
+    ]
+
+def _audio_args():
+    return ["-c:a", "aac", "-b:a", "128k"]
+
+def _encode_args(target_h):
+    return _video_args(target_h) + _audio_args()
+
+# What browsers play from an MP4 without help. Anything else is re-encoded.
+DELIVERABLE_VIDEO_CODECS = {"h264"}
+DELIVERABLE_PIX_FMTS = {"yuv420p", "yuvj420p"}
+DELIVERABLE_AUDIO_CODECS = {"aac"}
+
+def plan_output_args(info, target_h):
+    """
+    ffmpeg output args that only re-encode what has to change: an H.264
+    yuv420p stream no taller than the target is copied, and so is AAC audio.
+    Returns (args, label) where label names the path taken.
+    """
+    copy_video = (
+        info["video_codec"] in DELIVERABLE_VIDEO_CODECS
+        and info["pix_fmt"] in DELIVERABLE_PIX_FMTS
+        and bool(info["height"]) and info["height"] <= target_h
+    )
+    copy_audio = info["audio_codec"] is None or info["audio_codec"] in DELIVERABLE_AUDIO_CODECS
+
+    video = ["-c:v", "copy"] if copy_video else _video_args(target_h)
+    audio = ["-c:a", "copy"] if copy_audio else _audio_args()
+    if copy_video and copy_audio:
+        label = "remux"
+    elif copy_video:
+        label = "copy_video"
+    else:
+        label = "encode"
+    return video + audio, label
+
+def transcode_file(source, s3_output_key, output_args, local_output, reporter=None, extra_outputs=()):
+    ffmpeg_cmd = ["ffmpeg", "-y"] + _input_args(source) + output_args + [
+        "-movflags", "+faststart", local_output
+    ] + list(extra_outputs)
+    _run_ffmpeg(ffmpeg_cmd, reporter)
+
+    S3_CLIENT.upload_file(local_output, "processed-videos", s3_output_key)
+
+def _pipe_to_s3(ffmpeg_cmd, bucket, s3_key, reporter=None):
+    """Run ffmpeg with output on stdout and stream it into a multipart upload."""
+    upload = MultipartUpload(bucket, s3_key)
+    proc = _spawn_ffmpeg(ffmpeg_cmd, reporter, stdout=subprocess.PIPE)
+    try:
+        while True:
+            chunk = proc.stdout.read(PIPE_READ_SIZE)
+            if not chunk:
+                break
+            upload.write(chunk)
+        returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, "ffmpeg")
+        upload.complete()
+    except BaseException:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        upload.abort()
+        raise
+    finally:
+        proc.stdout.close()
+
+FRAGMENTED_MP4_ARGS = [
+    "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+    "-f", "mp4", "pipe:1",
+]
+
+def transcode_streaming(source, s3_output_key, output_args, reporter=None, extra_outputs=()):
+    """
+    Download, encode and upload overlap: ffmpeg pulls the source with HTTP
+    range requests and writes fragmented MP4 (moov up front, then moof/mdat
+    fragments) to stdout, which is fed part by part into S3.
+    """
+    ffmpeg_cmd = ["ffmpeg", "-nostdin", "-y"] + _input_args(source) + output_args + FRAGMENTED_MP4_ARGS + list(extra_outputs)
+    _pipe_to_s3(ffmpeg_cmd, "processed-videos", s3_output_key, reporter)
+
+# --- Segmented (parallel) transcoding ----------------------------------------
+# Only video is chunked; audio is encoded once during the stitch so AAC
+# priming gaps never land on chunk boundaries.
+
+def plan_chunks(source, duration):
+    """Keyframe-aligned (start, end) pairs, or None when the video is too short to split."""
+    if not duration or duration < SEGMENT_MIN_SECONDS * 2 or SEGMENT_COUNT < 2:
+        return None
+    count = min(SEGMENT_COUNT, int(duration // SEGMENT_MIN_SECONDS))
+    cuts = set()
+    for i in range(1, count):
+        keyframe = keyframe_near(source, duration * i / count)
+        if keyframe and 0 < keyframe < duration:
+            cuts.add(round(keyframe, 3))
+    if not cuts:
+        return None
+    starts = [0.0] + sorted(cuts)
+    return [(start, starts[i + 1] if i + 1 < len(starts) else None) for i, start in enumerate(starts)]
+
+def _chunk_cmd(source, start_time, end_time, target_h, output):
+    cmd = ["ffmpeg", "-nostdin", "-y", "-ss", str(start_time)] + _input_args(source)
+    if end_time is not None:
+        cmd += ["-t", str(end_time - start_time)]
+    # MPEG-TS concatenates cleanly with -c copy.
+    return cmd + ["-map", "0:v:0", "-an"] + _video_args(target_h) + ["-f", "mpegts", output]
+
+def _mark_chunk_done(db, chunk_id, job_id):
+    """
+    Flip one chunk to done and bump the job counter in one transaction.
+    Returns (done, total), or None if the chunk was already done (redelivery).
+    """
+    updated = db.execute(
+        text("UPDATE video_chunks SET status = 'done' WHERE id = :id AND status != 'done'"),
+        {"id": chunk_id},
+    ).rowcount
+    if not updated:
+        db.rollback()
+        return None
+    done, total = db.execute(
+        text(
+            "UPDATE video_jobs SET chunks_done = chunks_done + 1 WHERE id = :id "
+            "RETURNING chunks_done, chunks_total"
+        ),
+        {"id": job_id},
+    ).one()
+    db.commit()
+    return done, total
+
+def _create_chunks(db, job, bounds, key_for):
+    db.query(VideoChunk).filter(VideoChunk.job_id == job.id).delete()
+    chunks = [
+        VideoChunk(job_id=job.id, chunk_index=i, start_time=start, end_time=end, s3_key=key_for(i))
+        for i, (start, end) in enumerate(bounds)
+    ]
+    db.add_all(chunks)
+    job.chunks_total = len(chunks)
+    job.chunks_done = 0
+    db.commit()
+    return chunks
+
+def stitch_chunks(source, chunk_inputs, s3_output_key):
+    """Concat the encoded video chunks (-c copy) and add audio encoded once from the source."""
+    list_path = f"/tmp/concat_{os.getpid()}_{threading.get_ident()}.txt"
+    with open(list_path, "w") as f:
+        for item in chunk_inputs:
+            f.write(f"file '{item}'\n")
+    try:
+        ffmpeg_cmd = [
+            "ffmpeg", "-nostdin", "-y",
+            "-f", "concat", "-safe", "0",
+            "-protocol_whitelist", "file,http,https,tcp,tls,crypto",
+            "-i", list_path,
+        ] + _input_args(source) + [
+            "-map", "0:v:0", "-map", "1:a:0?",
+            "-c:v", "copy",
+        ] + _audio_args() + FRAGMENTED_MP4_ARGS
+        _pipe_to_s3(ffmpeg_cmd, "processed-videos", s3_output_key)
+    finally:
+        os.remove(list_path)
+
+def transcode_segmented_local(db, job, source, bounds, target_h, s3_output_key, work_dir, reporter):
+    """Encode every chunk in parallel on this host, then stitch."""
+    os.makedirs(work_dir, exist_ok=True)
+    chunks = _create_chunks(db, job, bounds, lambda i: os.path.join(work_dir, f"chunk_{i:04d}.ts"))
+    job_id = job.id
+    # Plain values for the encode threads: the Session isn't thread-safe, and
+    # touching the (expired) ORM objects there would refresh them through it.
+    work = [(c.id, c.start_time, c.end_time, c.s3_key) for c in chunks]
+
+    def encode(item):
+        chunk_id, start_time, end_time, output = item
+        subprocess.run(_chunk_cmd(source, start_time, end_time, target_h, output), check=True)
+        return chunk_id
+
+    with ThreadPoolExecutor(max_workers=min(SEGMENT_COUNT, len(work))) as pool:
+        for chunk_id in pool.map(encode, work):
+            progress = _mark_chunk_done(db, chunk_id, job_id)
+            if progress:
+                reporter.update(min(progress[0] / progress[1], 0.99))
+
+    stitch_chunks(source, [output for _, _, _, output in work], s3_output_key)
+
+def dispatch_chunks(db, job, input_filename, bounds, resolution):
+    """Queue one sub-job per chunk; the job completes when the last one is stitched."""
+    chunks = _create_chunks(db, job, bounds, lambda i: f"chunks/{job.id}/{i:04d}.ts")
+    for chunk in chunks:
+        publisher.publish_and_wait(VIDEO_QUEUE, {
+            "type": "chunk",
+            "job_id": job.id,
+            "chunk_id": chunk.id,
+            "filename": input_filename,
+            "resolution": resolution,
+        })
+    print(f"[*] Job {job.id} split into {len(chunks)} chunks")
+
+def process_chunk(job_id, chunk_id, input_filename, resolution="720p"):
+    """
+    Encode one chunk sub-job; stitch the video if it was the last chunk.
+
+    The delivery that finishes the last chunk stitches. A redelivered chunk
+    that is already done only matters when every chunk is done but the job
+    is still processing: the stitch never finished (the worker died or it
+    raised before completing), so it runs again. The output key is fixed
+    and completion is re-checked, so an overlapping second stitch costs
+    time, not correctness.
+    """
+    db = SessionLocal()
+    try:
+        chunk = db.query(VideoChunk).filter(VideoChunk.id == chunk_id).first()
+        job = db.query(VideoJob).filter(VideoJob.id == job_id).first()
+        if not chunk or not job or job.status != "processing":
+            return
+
+        source = get_presigned_url(input_filename, "raw-videos", expiration=SOURCE_URL_EXPIRY, public=False)
+        if chunk.status == "done":
+            if job.chunks_done < job.chunks_total:
+                return
+            print(f"[*] Resuming stitch of {job_id}")
+        else:
+            target_h = RESOLUTIONS.get(resolution, 720)
+            try:
+                chunk.status = "processing"
+                db.commit()
+                cmd = _chunk_cmd(source, chunk.start_time, chunk.end_time, target_h, "pipe:1")
+                _pipe_to_s3(cmd, "raw-videos", chunk.s3_key)
+            except Exception as e:
+                print(f"[!] Chunk {chunk.chunk_index} of {job_id} failed: {e}")
+                chunk.status = "failed"
+                _fail_job(db, job, input_filename)
+                return
+
+            progress = _mark_chunk_done(db, chunk.id, job_id)
+            if not progress:
+                return
+            done, total = progress
+            store_progress(job_id, job.owner_id, int(min(done / total, 0.99) * 100))
+            if done < total:
+                return
+
+        s3_output_key = f"processed/user_{job.owner_id}/{job_id}.mp4"
+        try:
+            chunk_urls = [
+                get_presigned_url(c.s3_key, "raw-videos", expiration=SOURCE_URL_EXPIRY, public=False)
+                for c in job.chunks
+            ]
+            stitch_chunks(source, chunk_urls, s3_output_key)
+        except Exception as e:
+            print(f"[!] Stitching {job_id} failed: {e}")
+            _fail_job(db, job, input_filename)
+            return
+        db.refresh(job)
+        if job.status != "processing":  # an overlapping stitch got there first
+            return
+        _complete_job(db, job, input_filename, s3_output_key)
+    finally:
+        db.close()
+
+def _delete_chunk_objects(job):
+    for chunk in job.chunks:
+        if chunk.s3_key and chunk.s3_key.startswith("chunks/"):
+            try:
+                S3_CLIENT.delete_object(Bucket="raw-videos", Key=chunk.s3_key)
+            except Exception:
+                pass
+
+# --- Adaptive bitrate (HLS / CMAF) -------------------------------------------
+
+def _ladder_for(source_height):
+    """Rungs no taller than the source — upscaling only wastes bits."""
+    rungs = sorted(set(ABR_LADDER), reverse=True)
+    if source_height:
+        fitting = [h for h in rungs if h <= source_height]
+        return fitting or [rungs[-1]]
+    return rungs
+
+def _hls_args(rungs, has_audio, out_dir):
+    n = len(rungs)
+    filters = f"[0:v]split={n}" + "".join(f"[s{i}]" for i in range(n)) + ";" + ";".join(
+        f"[s{i}]scale=-2:{h}[v{i}]" for i, h in enumerate(rungs)
+    )
+    args = ["-filter_complex", filters]
+    for i, h in enumerate(rungs):
+        kbps = ABR_BITRATES.get(h, h * 3)
+        args += [
+            "-map", f"[v{i}]",
+            f"-c:v:{i}", "libx264",
+            f"-b:v:{i}", f"{kbps}k",
+            f"-maxrate:v:{i}", f"{int(kbps * 1.07)}k",
+            f"-bufsize:v:{i}", f"{int(kbps * 1.5)}k",
+        ]
+        if has_audio:
+            args += ["-map", "0:a:0"]
+    if has_audio:
+        args += ["-c:a", "aac", "-b:a", "128k", "-ac", "2"]
+
+    stream_map = " ".join(f"v:{i},a:{i}" if has_audio else f"v:{i}" for i in range(n))
+    args += [
+        "-preset", "veryfast",
+        # Same keyframe positions on every rung, so players can switch at any segment.
+        "-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+        "-sc_threshold", "0",
+        "-f", "hls",
+        "-hls_time", str(HLS_SEGMENT_SECONDS),
+        "-hls_playlist_type", "vod",
+        "-hls_segment_type", "fmp4",
+        "-hls_flags", "independent_segments",
+        "-hls_fmp4_init_filename", "init_%v.mp4",
+        "-hls_segment_filename", os.path.join(out_dir, "seg_%v_%05d.m4s"),
+        "-master_pl_name", "master.m3u8",
+        "-var_stream_map", stream_map,
+        os.path.join(out_dir, "index_%v.m3u8"),
+    ]
+    return args
+
+class HlsSegmentUploader(threading.Thread):
+    """
+    Ships HLS output to S3 while ffmpeg is still encoding. A segment is
+    uploaded (and deleted locally) as soon as a variant playlist lists it,
+    so local disk only ever holds a few segments. Playlists go up last.
+    """
+
+    def __init__(self, out_dir, s3_prefix):
+        super().__init__(daemon=True)
+        self.out_dir = out_dir
+        self.s3_prefix = s3_prefix
+        self.error = None
+        self._uploaded = set()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(1):
+            try:
+                self._upload_listed_segments()
+            except Exception as e:
+                self.error = e
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def finish(self):
+        """Stop polling and upload everything that is left, master playlist last."""
+        self.stop()
+        if self.error:
+            raise self.error
+        names = sorted(os.listdir(self.out_dir))
+        media = [n for n in names if not n.endswith(".m3u8")]
+        playlists = [n for n in names if n.endswith(".m3u8") and n != "master.m3u8"]
+        for name in media + playlists + ["master.m3u8"]:
+            self._upload(name)
+
+    def _upload_listed_segments(self):
+        for name in os.listdir(self.out_dir):
+            if not (name.startswith("index_") and name.endswith(".m3u8")):
+                continue
+            with open(os.path.join(self.out_dir, name)) as f:
+                lines = f.read().splitlines()
+            for line in lines:
+                if line.startswith("#EXT-X-MAP:"):
+                    self._upload(line.split('URI="', 1)[1].split('"', 1)[0])
+                elif line and not line.startswith("#"):
+                    self._upload(line)
+
+    def _upload(self, name):
+        path = os.path.join(self.out_dir, name)
+        if name in self._uploaded or not os.path.exists(path):
+            return
+        content_type = HLS_CONTENT_TYPES.get(os.path.splitext(name)[1], "application/octet-stream")
+        S3_CLIENT.upload_file(
+            path, "processed-videos", self.s3_prefix + name,
+            ExtraArgs={"ContentType": content_type}
+        )
+        self._uploaded.add(name)
+        os.remove(path)
+
+def transcode_hls(source, info, owner_id, job_id, out_dir, reporter=None, extra_outputs=()):
+    """Returns the S3 key of the master playlist."""
+    rungs = _ladder_for(info["height"])
+    s3_prefix = f"processed/user_{owner_id}/{job_id}/hls/"
+    print(f"[*] ABR ladder for {job_id}: {rungs}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    ffmpeg_cmd = ["ffmpeg", "-nostdin", "-y"] + _input_args(source) + _hls_args(
+        rungs, info["audio_codec"] is not None, out_dir
+    ) + list(extra_outputs)
+
+    uploader = HlsSegmentUploader(out_dir, s3_prefix)
+    uploader.start()
+    try:
+        _run_ffmpeg(ffmpeg_cmd, reporter)
+        uploader.finish()
+    except BaseException:
+        uploader.stop()
+        delete_processed_output(s3_prefix + "master.m3u8")
+        raise
+    return s3_prefix + "master.m3u8"
+
+# --- AI keyframes & poster ---------------------------------------------------
+# Encodes already decode every frame, so the JPEGs the summarizer needs are
+# cut in the same ffmpeg run as extra outputs. Paths that don't decode
+# (remux / stream copy) or that split the work (segmented) sample the
+# finished output over range requests instead.
+
+AI_KEYFRAME_POSITIONS = frames.keyframe_positions()
+POSTER_POSITION = float(os.getenv("POSTER_POSITION", 0.1))
+POSTER_WIDTH = int(os.getenv("POSTER_WIDTH", 1280))
+
+def _frame_output_args(duration, frames_dir):
+    """Extra ffmpeg outputs: the first frame at/after each keyframe position, and a poster."""
+    if not duration:
+        return []
+    os.makedirs(frames_dir, exist_ok=True)
+    times = [duration * p for p in AI_KEYFRAME_POSITIONS]
+    # Each term fires once: on the first frame past T that comes after the last pick before T.
+    pick = "+".join(
+        f"gte(t,{t:.3f})*(isnan(prev_selected_t)+lt(prev_selected_t,{t:.3f}))" for t in times
+    )
+    return [
+        "-map", "0:v:0",
+        "-vf", f"select='gt({pick},0)',scale='min({frames.FRAME_SAMPLE_WIDTH},iw)':-2",
+        "-fps_mode", "vfr", "-q:v", "4",
+        os.path.join(frames_dir, "kf_%02d.jpg"),
+        "-map", "0:v:0",
+        "-vf", f"select='gte(t,{duration * POSTER_POSITION:.3f})',scale='min({POSTER_WIDTH},iw)':-2",
+        "-frames:v", "1", "-q:v", "3",
+        os.path.join(frames_dir, "poster.jpg"),
+    ]
+
+def _frames_prefix(job):
+    return f"processed/user_{job.owner_id}/{job.id}/frames/"
+
+def _store_frames(job, keyframes, poster):
+    """Upload (position, jpeg bytes) keyframes and the poster; record their keys on the job."""
+    prefix = _frames_prefix(job)
+    entries = []
+    for i, (position, data) in enumerate(keyframes, start=1):
+        key = f"{prefix}kf_{i:02d}.jpg"
+        S3_CLIENT.put_object(Bucket="processed-videos", Key=key, Body=data, ContentType="image/jpeg")
+        entries.append({"at": position, "key": key})
+    job.keyframe_keys = json.dumps(entries) if entries else None
+    if poster:
+        key = f"{prefix}poster.jpg"
+        S3_CLIENT.put_object(Bucket="processed-videos", Key=key, Body=poster, ContentType="image/jpeg")
+        job.poster_key = key
+
+def _collect_frame_outputs(job, frames_dir):
+    """Upload what _frame_output_args wrote."""
+    if not os.path.isdir(frames_dir):
+        return
+    names = sorted(n for n in os.listdir(frames_dir) if n.startswith("kf_"))
+    keyframes = []
+    for position, name in zip(AI_KEYFRAME_POSITIONS, names):
+        with open(os.path.join(frames_dir, name), "rb") as f:
+            keyframes.append((position, f.read()))
+    poster = None
+    poster_path = os.path.join(frames_dir, "poster.jpg")
+    if os.path.exists(poster_path):
+        with open(poster_path, "rb") as f:
+            poster = f.read()
+    _store_frames(job, keyframes, poster)
+
+def _sample_frames_from_output(job, s3_output_key):
+    """Fallback for paths without a decode: seek into the finished output."""
+    keyframes = frames.sample_frames(s3_output_key, positions=AI_KEYFRAME_POSITIONS)
+    poster = frames.sample_frames(s3_output_key, positions=[POSTER_POSITION], width=POSTER_WIDTH)
+    _store_frames(job, keyframes, poster[0][1] if poster else None)
+
+RESOLUTIONS = {"1080p": 1080, "720p": 720, "480p": 480}
+
+def _complete_job(db, job, input_filename, s3_output_key):
+    if not job.keyframe_keys:
+        try:
+            _sample_frames_from_output(job, s3_output_key)
+        except Exception as e:
+            # The summarizer samples on demand when no keyframes are stored.
+            print(f"[!] Could not store AI keyframes for {job.id}: {e}")
+
+    job.status = "completed"
+    job.s3_key = s3_output_key
+    job.processed_at = datetime.datetime.utcnow()
+    job.progress = 100
+    job.eta_seconds = 0
+    db.commit()
+    search.index_video(job)
+
+    send_notification(job.owner_id, job.id, "completed", "Video is ready!")
+
+    try:
+        S3_CLIENT.delete_object(Bucket="raw-videos", Key=input_filename)
+    except Exception:
+        pass
+    _delete_chunk_objects(job)
+
+    print(f"[#] Job {job.id} completed.")
+
+def _fail_job(db, job, input_filename):
+    job.status = "failed"
+    db.commit()
+    search.update_video(job.id, status="failed")
+    _delete_chunk_objects(job)
+    send_notification(job.owner_id, job.id, "failed", "Processing failed")
+
+def _hash_raw_object(key):
+    """sha256 of a raw upload, read back from S3 in 1 MiB pieces."""
+    body = S3_CLIENT.get_object(Bucket="raw-videos", Key=key)["Body"]
+    hasher = hashlib.sha256()
+    for chunk in body.iter_chunks(1024 * 1024):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+def _reuse_duplicate(db, job, input_filename, resolution):
+    """
+    Direct uploads go straight to S3, so unlike form uploads the API never
+    hashed them: hash the raw object here and, if the same bytes were already
+    transcoded at this resolution, point at that output instead of encoding.
+    Returns True when the job was completed that way.
+    """
+    try:
+        job.content_hash = _hash_raw_object(input_filename)
+        db.commit()
+    except Exception as e:
+        # Dedup is an optimization; transcode as usual.
+        print(f"[!] Could not hash raw upload for {job.id}: {e}")
+        db.rollback()
+        return False
+
+    original = db.query(VideoJob).filter(
+        VideoJob.content_hash == job.content_hash,
+        VideoJob.resolution == resolution,
+        VideoJob.status == "completed",
+        VideoJob.s3_key.isnot(None),
+        VideoJob.id != job.id,
+    ).first()
+    if not original:
+        return False
+
+    job.status = "completed"
+    job.s3_key = original.s3_key
+    job.keyframe_keys = original.keyframe_keys
+    job.poster_key = original.poster_key
+    job.processed_at = datetime.datetime.utcnow()
+    job.progress = 100
+    job.eta_seconds = 0
+    db.commit()
+    search.index_video(job)
+    metrics.incr("upload.dedup_hits")
+    print(f"[=] Job {job.id} duplicates {original.id}; reusing {original.s3_key}")
+    send_notification(job.owner_id, job.id, "completed", "Video is ready!")
+    try:
+        S3_CLIENT.delete_object(Bucket="raw-videos", Key=input_filename)
+    except Exception:
+        pass
+    return True
+
 def process_video(job_id, input_filename, resolution="720p"):
     db = SessionLocal()
     job = db.query(VideoJob).filter(VideoJob.id == job_id).first()
@@ -37,62 +765,203 @@ def process_video(job_id, input_filename, resolution="720p"):
 
     local_input = f"/tmp/{input_filename.split('/')[-1]}"
     local_output = f"/tmp/processed_{job_id}.mp4"
+    local_hls_dir = f"/tmp/hls_{job_id}"
+    local_chunk_dir = f"/tmp/chunks_{job_id}"
+    local_frames_dir = f"/tmp/frames_{job_id}"
 
     try:
         send_notification(job.owner_id, job_id, "processing", "Processing started...")
 
         job.status = "processing"
         db.commit()
-        print(f"[*] Processing job {job_id} ({resolution})...")
-
-        s3_output_key = f"processed/user_{job.owner_id}/{job_id}.mp4"
+        if job.content_hash is None and _reuse_duplicate(db, job, input_filename, resolution):
+            return
+        print(f"[*] Processing job {job_id} ({resolution}, {OUTPUT_FORMAT}, {TRANSCODE_MODE})...")
 
-        S3_CLIENT.download_file("raw-videos", input_filename, local_input)
-
-        res_map = {"1080p": 1080, "720p": 720, "480p": 480}
-        target_h = res_map.get(resolution, 720)
-
-        ffmpeg_cmd = [
-            "ffmpeg", "-y", "-i", local_input,
-            "-vf", f"scale=-2:{target_h}",
-            "-c:v", "libx264", "-crf", "23", "-preset", "veryfast",
-            "-c:a", "aac", "-b:a", "128k",
-            local_output
-        ]
+        target_h = RESOLUTIONS.get(resolution, 720)
 
-        subprocess.run(ffmpeg_cmd, check=True)
-
-        S3_CLIENT.upload_file(local_output, "processed-videos", s3_output_key)
-
-        job.status = "completed"
-        job.s3_key = s3_output_key
-        job.processed_at = datetime.datetime.utcnow()
-        db.commit()
+        if OUTPUT_FORMAT == "mp4" and SEGMENTED_TRANSCODE == "distributed":
+            # Only probed here; chunk workers read the source over HTTP themselves.
+            source = get_presigned_url(input_filename, "raw-videos", expiration=SOURCE_URL_EXPIRY, public=False)
+        else:
+            source = _open_source(input_filename, local_input)
+        s3_output_key = f"processed/user_{job.owner_id}/{job_id}.mp4"
+        info = probe_source(source)
+        reporter = ProgressReporter(job_id, job.owner_id, info["duration"])
+        bounds = None
+        plan = None
+        if OUTPUT_FORMAT == "mp4":
+            output_args, plan = plan_output_args(info, target_h)
+            print(f"[*] Job {job_id}: {plan} ({info['video_codec']}/{info['audio_codec']}, {info['height']}p)")
+            metrics.incr(f"transcode.plan.{plan}")
+            # Copying video is already fast; only full encodes are worth splitting.
+            if plan == "encode" and SEGMENTED_TRANSCODE in ("local", "distributed"):
+                bounds = plan_chunks(source, info["duration"])
 
-        send_notification(job.owner_id, job_id, "completed", "Video is ready!")
+        # Decoding paths cut the AI keyframes and poster on the way through.
+        decodes = OUTPUT_FORMAT == "hls" or (plan == "encode" and not bounds)
+        frame_outputs = _frame_output_args(info["duration"], local_frames_dir) if decodes else []
 
-        try:
-            S3_CLIENT.delete_object(Bucket="raw-videos", Key=input_filename)
-        except Exception:
-            pass
+        if OUTPUT_FORMAT == "hls":
+            s3_output_key = transcode_hls(source, info, job.owner_id, job_id, local_hls_dir, reporter, frame_outputs)
+        elif bounds and SEGMENTED_TRANSCODE == "distributed":
+            # Chunk workers read the raw object themselves; nothing more to do here.
+            dispatch_chunks(db, job, input_filename, bounds, resolution)
+            return
+        elif bounds:
+            transcode_segmented_local(db, job, source, bounds, target_h, s3_output_key, local_chunk_dir, reporter)
+        elif TRANSCODE_MODE == "stream":
+            transcode_streaming(source, s3_output_key, output_args, reporter, frame_outputs)
+        else:
+            transcode_file(source, s3_output_key, output_args, local_output, reporter, frame_outputs)
 
-        print(f"[#] Job {job_id} completed.")
+        if frame_outputs:
+            try:
+                _collect_frame_outputs(job, local_frames_dir)
+            except Exception as e:
+                print(f"[!] Could not upload AI keyframes for {job_id}: {e}")
+        _complete_job(db, job, input_filename, s3_output_key)
 
     except Exception as e:
         print(f"[!] Error: {e}")
-        job.status = "failed"
-        db.commit()
-        send_notification(job.owner_id, job_id, "failed", "Processing failed")
+        db.rollback()
+        _fail_job(db, job, input_filename)
     finally:
         if os.path.exists(local_input): os.remove(local_input)
         if os.path.exists(local_output): os.remove(local_output)
+        shutil.rmtree(local_hls_dir, ignore_errors=True)
+        shutil.rmtree(local_chunk_dir, ignore_errors=True)
+        shutil.rmtree(local_frames_dir, ignore_errors=True)
         db.close()
 
-def callback(ch, method, properties, body):
+def run_message(body):
+    """Entry point for one queue message; runs inside a pool process."""
     data = json.loads(body)
     res = data.get('resolution', '720p')
-    process_video(data['job_id'], data['filename'], res)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    if data.get('type') == 'chunk':
+        process_chunk(data['job_id'], data['chunk_id'], data['filename'], res)
+    else:
+        process_video(data['job_id'], data['filename'], res)
+
+# --- Host capacity ------------------------------------------------------------
+
+def _available_cores():
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    # Respect a container CPU quota (cgroup v2) when one is set.
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cores = min(cores, float(quota) / float(period))
+    except (OSError, ValueError):
+        pass
+    return cores
+
+def _free_disk_mb(path="/tmp"):
+    return shutil.disk_usage(path).free // (1024 * 1024)
+
+def _available_memory_mb():
+    available = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) // 1024
+                    break
+    except OSError:
+        pass
+    # A container memory limit (cgroup v2) can be far below the host's.
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        with open("/sys/fs/cgroup/memory.current") as f:
+            current = int(f.read().strip())
+        if limit != "max":
+            room = (int(limit) - current) // (1024 * 1024)
+            available = room if available is None else min(available, room)
+    except (OSError, ValueError):
+        pass
+    return available
+
+def max_concurrency():
+    if WORKER_CONCURRENCY != "auto":
+        return max(1, int(WORKER_CONCURRENCY))
+    limits = [int(_available_cores() // CORES_PER_JOB), _free_disk_mb() // DISK_PER_JOB_MB]
+    memory = _available_memory_mb()
+    if memory is not None:
+        limits.append(memory // MEM_PER_JOB_MB)
+    return max(1, min(limits))
+
+def has_headroom():
+    """Room for one more job right now (disk and memory move as jobs run)."""
+    memory = _available_memory_mb()
+    return _free_disk_mb() >= DISK_PER_JOB_MB and (memory is None or memory >= MEM_PER_JOB_MB)
+
+# --- Consumer -----------------------------------------------------------------
+
+class ConcurrentConsumer:
+    """
+    Receives messages on the pika connection thread and hands them to a
+    process pool. The callback returns immediately, so the connection keeps
+    servicing heartbeats during long encodes; each message is acked from the
+    connection thread only when its job has finished.
+    """
+
+    def __init__(self, connection, channel, limit):
+        self.connection = connection
+        self.channel = channel
+        self.limit = limit
+        self.running = 0
+        self.waiting = deque()
+        self._retry_scheduled = False
+        self.pool = self._new_pool()
+
+    def _new_pool(self):
+        # spawn: children must not inherit the parent's pika socket.
+        return ProcessPoolExecutor(max_workers=self.limit, mp_context=multiprocessing.get_context("spawn"))
+
+    def on_message(self, ch, method, properties, body):
+        self.waiting.append((method.delivery_tag, body))
+        self._admit()
+
+    def _admit(self):
+        self._retry_scheduled = False
+        while self.waiting and self.running < self.limit:
+            # Never stall completely: an idle worker always takes one job.
+            if self.running > 0 and not has_headroom():
+                break
+            tag, body = self.waiting.popleft()
+            try:
+                future = self.pool.submit(run_message, body)
+            except BrokenProcessPool:
+                self.waiting.appendleft((tag, body))
+                if self.running:
+                    break  # rebuilt once the remaining futures have failed
+                self.pool = self._new_pool()
+                continue
+            self.running += 1
+            future.add_done_callback(
+                lambda f, tag=tag: self.connection.add_callback_threadsafe(
+                    functools.partial(self._on_done, tag, f)
+                )
+            )
+        if self.waiting and not self._retry_scheduled:
+            self._retry_scheduled = True
+            self.connection.call_later(ADMISSION_RETRY_SECONDS, self._admit)
+
+    def _on_done(self, tag, future):
+        self.running -= 1
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            print(f"[!] Worker process died: {error}")
+            self.channel.basic_nack(delivery_tag=tag, requeue=True)
+            if self.running == 0:
+                self.pool = self._new_pool()
+        else:
+            if error:
+                print(f"[!] Job crashed: {error}")
+            self.channel.basic_ack(delivery_tag=tag)
+        self._admit()
 
 def main():
     rabbitmq_host = os.getenv("RABBITMQ_HOST", "rabbitmq")
@@ -104,19 +973,21 @@ def main():
     while not connection:
         try:
             connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host=rabbitmq_host, credentials=credentials, heartbeat=600)
+                pika.ConnectionParameters(host=rabbitmq_host, credentials=credentials, heartbeat=60)
             )
         except Exception:
             print("Retrying RabbitMQ...")
             time.sleep(5)
 
+    limit = max_concurrency()
     channel = connection.channel()
     QUEUE_NAME = 'video_tasks'
     channel.queue_declare(queue=QUEUE_NAME, durable=True)
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback)
+    channel.basic_qos(prefetch_count=limit)
+    consumer = ConcurrentConsumer(connection, channel, limit)
+    channel.basic_consume(queue=QUEUE_NAME, on_message_callback=consumer.on_message)
 
-    print(' [*] Worker Ready')
+    print(f' [*] Worker Ready (up to {limit} concurrent jobs)')
     channel.start_consuming()
 
 if __name__ == "__main__":
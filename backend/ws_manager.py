@@ -1,28 +1,176 @@
+"""
+Per-process registry of WebSocket connections.
+
+Each socket gets a small bounded send queue drained by its own task, so a
+push to a user only enqueues and returns: one slow or dead socket can no
+longer hold up the user's other tabs or the request that triggered the push.
+
+Queued messages are keyed. A newer `video_update` for the same video
+replaces the one still waiting (the client only needs the latest status),
+everything else gets a unique key and is never coalesced. When a queue
+fills up anyway the client is too slow to keep up and is disconnected;
+the dashboard reconnects and refetches.
+
+A single heartbeat task pings every socket and evicts the ones that have
+not sent anything (the client answers "pong") within WS_PING_TIMEOUT.
+"""
+import asyncio
+import itertools
+import os
+import time
+from collections import OrderedDict
+
 from fastapi import WebSocket
 
+import metrics
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", 64))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", 10))
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", 20))
+WS_PING_TIMEOUT = float(os.getenv("WS_PING_TIMEOUT", 60))
+
+_unique = itertools.count()
+
+
+def _coalesce_key(message: dict):
+    kind = message.get("type")
+    if kind == "video_update":
+        return (kind, message.get("video_id"))
+    if kind == "ping":
+        return (kind,)
+    return (kind, next(_unique))
+
+
+class Connection:
+    def __init__(self, manager, user_id: int, websocket: WebSocket):
+        self.manager = manager
+        self.user_id = user_id
+        self.websocket = websocket
+        self.last_seen = time.monotonic()
+        self.closed = False
+        self._pending: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._ready = asyncio.Event()
+        self._sender = None
+
+    def start(self):
+        self._sender = asyncio.create_task(self._drain())
+
+    def mark_alive(self):
+        self.last_seen = time.monotonic()
+
+    def enqueue(self, message: dict) -> bool:
+        """Queue a message without waiting. Returns False if the client can't keep up."""
+        if self.closed:
+            return False
+        key = _coalesce_key(message)
+        if key in self._pending:
+            # Superseded status update: keep its place in line, send the newest.
+            self._pending[key] = message
+            self.manager.coalesced += 1
+        elif len(self._pending) >= WS_SEND_QUEUE_SIZE:
+            return False
+        else:
+            self._pending[key] = message
+        self._ready.set()
+        return True
+
+    async def _drain(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self._pending:
+                    _, message = self._pending.popitem(last=False)
+                    await asyncio.wait_for(self.websocket.send_json(message), WS_SEND_TIMEOUT)
+                self._ready.clear()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[ws] Send to user {self.user_id} failed: {e}")
+            self.manager.evict(self, reason="send_failed")
+
+    async def close(self):
+        self._pending.clear()
+        if self._sender and self._sender is not asyncio.current_task():
+            self._sender.cancel()
+        try:
+            await asyncio.wait_for(self.websocket.close(), WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: dict[int, list[WebSocket]] = {}
+        self.active_connections: dict[int, list[Connection]] = {}
+        self.coalesced = 0
+        self.evicted: dict[str, int] = {}
+        self._heartbeat = None
+        self._closing = set()
 
-    async def connect(self, user_id: int, websocket: WebSocket):
+    async def connect(self, user_id: int, websocket: WebSocket) -> Connection:
         await websocket.accept()
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
+        connection = Connection(self, user_id, websocket)
+        connection.start()
+        self.active_connections.setdefault(user_id, []).append(connection)
+        self._ensure_heartbeat()
         print(f"User {user_id} connected via WebSocket")
+        return connection
+
+    def disconnect(self, connection: Connection):
+        connections = self.active_connections.get(connection.user_id)
+        if connections and connection in connections:
+            connections.remove(connection)
+            if not connections:
+                del self.active_connections[connection.user_id]
+            print(f"User {connection.user_id} disconnected")
+        if connection._sender and connection._sender is not asyncio.current_task():
+            connection._sender.cancel()
 
-    def disconnect(self, user_id: int, websocket: WebSocket):
-        if user_id in self.active_connections:
-            self.active_connections[user_id].remove(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-            print(f"User {user_id} disconnected")
+    def evict(self, connection: Connection, reason: str):
+        """Drop the socket now; the close handshake finishes in the background."""
+        if connection.closed:
+            return
+        connection.closed = True
+        print(f"[ws] Evicting socket of user {connection.user_id}: {reason}")
+        self.evicted[reason] = self.evicted.get(reason, 0) + 1
+        self.disconnect(connection)
+        task = asyncio.create_task(connection.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
 
     async def send_personal_message(self, message: dict, user_id: int):
-        if user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                await connection.send_json(message)
+        """Fan the message out to every socket of the user; never waits on the network."""
+        for connection in list(self.active_connections.get(user_id, ())):
+            if not connection.enqueue(message):
+                self.evict(connection, reason="slow_consumer")
+
+    def connection_count(self) -> int:
+        return sum(len(c) for c in self.active_connections.values())
+
+    # --- liveness -------------------------------------------------------------
+
+    def _ensure_heartbeat(self):
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(WS_PING_INTERVAL)
+            now = time.monotonic()
+            for connections in list(self.active_connections.values()):
+                for connection in list(connections):
+                    if now - connection.last_seen > WS_PING_TIMEOUT:
+                        self.evict(connection, reason="no_pong")
+                    elif not connection.enqueue({"type": "ping"}):
+                        self.evict(connection, reason="slow_consumer")
+
+            # Reported once per interval to keep Redis off the per-message path.
+            metrics.gauge("ws.connections", self.connection_count())
+            if self.coalesced:
+                metrics.incr("ws.coalesced", self.coalesced)
+                self.coalesced = 0
+            for reason, count in self.evicted.items():
+                metrics.incr(f"ws.evicted.{reason}", count)
+            self.evicted.clear()
 
 
 # Singleton shared across the entire application process
@@ -0,0 +1,49 @@
+"use client";
+import { useEffect, useRef } from "react";
+import type Hls from "hls.js";
+
+interface VideoPlayerProps {
+  src: string;
+  // "mp4" or "hls", as returned by /videos/play
+  format?: string;
+  className?: string;
+}
+
+export default function VideoPlayer({ src, format = "mp4", className }: VideoPlayerProps) {
+  const videoRef = useRef<HTMLVideoElement>(null);
+
+  useEffect(() => {
+    const video = videoRef.current;
+    if (!video) return;
+
+    // Progressive MP4, or HLS on browsers that play it natively (Safari, iOS).
+    if (format !== "hls" || video.canPlayType("application/vnd.apple.mpegurl")) {
+      video.src = src;
+      return () => {
+        video.removeAttribute("src");
+        video.load();
+      };
+    }
+
+    // Everywhere else HLS goes through hls.js (Media Source Extensions),
+    // loaded only when an adaptive stream is actually played.
+    let hls: Hls | null = null;
+    let cancelled = false;
+    import("hls.js").then(({ default: HlsPlayer }) => {
+      if (cancelled) return;
+      if (!HlsPlayer.isSupported()) {
+        console.error("This browser cannot play HLS streams");
+        return;
+      }
+      hls = new HlsPlayer();
+      hls.loadSource(src);
+      hls.attachMedia(video);
+    });
+    return () => {
+      cancelled = true;
+      hls?.destroy();
+    };
+  }, [src, format]);
+
+  return <video ref={videoRef} controls autoPlay className={className} />;
+}
@@ -4,6 +4,7 @@ import { ApiService } from "@/lib/services";
 import { useRouter } from "next/navigation";
 import Navbar from "@/app/components/Navbar";
 import AISidebar from "@/app/components/AISidebar";
+import VideoPlayer from "@/app/components/VideoPlayer";
 import type { Video, User } from "@/lib/types";
 
 export default function DashboardPage() {
@@ -16,7 +17,7 @@ export default function DashboardPage() {
   const [resolution, setResolution] = useState("720p");
   const [isUploading, setIsUploading] = useState(false);
   const [viewMode, setViewMode] = useState<"private" | "feed">("private");
-  const [selectedVideoUrl, setSelectedVideoUrl] = useState<string | null>(null);
+  const [selectedVideo, setSelectedVideo] = useState<{ url: string; format: string } | null>(null);
   const [isMounted, setIsMounted] = useState(false);
   const [isAdmin, setIsAdmin] = useState(false);
 
@@ -50,10 +51,22 @@ export default function DashboardPage() {
     socket.onmessage = (event) => {
       const data = JSON.parse(event.data);
 
-      if (data.type === "video_update") {
+      if (data.type === "ping") {
+        // Server heartbeat — sockets that stop answering are evicted.
+        socket.send("pong");
+      } else if (data.type === "video_update") {
         setVideos((prev) =>
-          prev.map((v) => v.id === data.video_id ? { ...v, status: data.status } : v)
+          prev.map((v) => v.id === data.video_id
+            ? { ...v, status: data.status, progress: data.progress ?? v.progress, eta_seconds: data.eta_seconds ?? v.eta_seconds }
+            : v)
         );
+      } else if (data.type === "summary_delta") {
+        // Synthesis is streamed — show the summary as it is written; seq 0 starts a new one.
+        const videoTitle: string = data.video_title || data.video_id;
+        setActiveSummaryVideo((prev) => ({
+          title: videoTitle,
+          summary: (data.seq > 0 && prev?.title === videoTitle ? prev.summary : "") + data.delta,
+        }));
       } else if (data.type === "summary_ready") {
         // AI background task finished — update the video card and show the sidebar
         const summary: string = data.summary || "Analysis failed.";
@@ -117,7 +130,7 @@ export default function DashboardPage() {
       const res = await ApiService.getPlayUrl(videoId);
       if (res.ok) {
         const data = await res.json();
-        setSelectedVideoUrl(data.url);
+        setSelectedVideo({ url: data.url, format: data.format });
       } else {
         alert("Could not load video.");
       }
@@ -245,7 +258,7 @@ export default function DashboardPage() {
               <div>
                 <div className="flex justify-between items-start mb-2">
                   <span className="text-[10px] font-black bg-gray-200 text-black px-2 py-1 border border-black uppercase">{v.category || "Other"}</span>
-                  <span className={`text-[10px] font-black px-2 py-1 border border-black uppercase text-black ${v.status === "completed" ? "bg-green-400" : v.status === "failed" ? "bg-red-500 text-white" : "bg-yellow-300 animate-pulse"}`}>{v.status}</span>
+                  <span className={`text-[10px] font-black px-2 py-1 border border-black uppercase text-black ${v.status === "completed" ? "bg-green-400" : v.status === "failed" ? "bg-red-500 text-white" : "bg-yellow-300 animate-pulse"}`}>{v.status}{v.status === "processing" && v.progress ? ` ${v.progress}%` : ""}</span>
                 </div>
 
                 <h4 className="text-xl font-black text-black leading-tight mb-1 truncate">{v.title}</h4>
@@ -314,11 +327,11 @@ export default function DashboardPage() {
         </div>
       </div>
 
-      {selectedVideoUrl && (
+      {selectedVideo && (
         <div className="fixed inset-0 bg-black/90 backdrop-blur-sm flex items-center justify-center z-[50] p-4">
           <div className="relative w-full max-w-5xl border-4 border-white shadow-[0px_0px_50px_rgba(255,255,255,0.2)] bg-black">
-            <button type="button" onClick={() => setSelectedVideoUrl(null)} className="absolute -top-12 right-0 text-white font-black text-xl hover:text-red-500 transition-colors">CLOSE [X]</button>
-            <video key={selectedVideoUrl} controls autoPlay className="w-full h-auto max-h-[80vh]"><source src={selectedVideoUrl} type="video/mp4" /></video>
+            <button type="button" onClick={() => setSelectedVideo(null)} className="absolute -top-12 right-0 text-white font-black text-xl hover:text-red-500 transition-colors">CLOSE [X]</button>
+            <VideoPlayer key={selectedVideo.url} src={selectedVideo.url} format={selectedVideo.format} className="w-full h-auto max-h-[80vh]" />
           </div>
         </div>
       )}
@@ -3,13 +3,17 @@ import { useEffect, useState } from "react";
 import Navbar from "@/app/components/Navbar";
 import { ApiService } from "@/lib/services"; 
 import AISidebar from "@/app/components/AISidebar"; 
+import VideoPlayer from "@/app/components/VideoPlayer";
 
 export default function PublicFeed() {
   const [videos, setVideos] = useState<any[]>([]);
   const [search, setSearch] = useState("");
   const [category, setCategory] = useState("All");
   const [loading, setLoading] = useState(false);
-  const [playingUrl, setPlayingUrl] = useState<string | null>(null);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const [suggestions, setSuggestions] = useState<{id: string, title: string}[]>([]);
+  const [playing, setPlaying] = useState<{ url: string; format: string } | null>(null);
   const [isAdmin, setIsAdmin] = useState(false); 
   const categories = ["All", "Tech", "Gaming", "Music", "Other"];
   const [activeSummaryVideo, setActiveSummaryVideo] = useState<{title: string, summary: string} | null>(null);
@@ -31,7 +35,10 @@ export default function PublicFeed() {
       setLoading(true);
       try {
         const res = await ApiService.searchVideos(search, category);
-        if (res.ok) setVideos(await res.json());
+        if (res.ok) {
+          setVideos(await res.json());
+          setNextCursor(res.headers.get("X-Next-Cursor"));
+        }
       } catch (e) { console.error("Search failed", e); } 
       finally { setLoading(false); }
     };
@@ -39,12 +46,37 @@ export default function PublicFeed() {
     return () => clearTimeout(timeout);
   }, [search, category]);
 
+  useEffect(() => {
+    if (!search.trim()) { setSuggestions([]); return; }
+    const timeout = setTimeout(async () => {
+      try {
+        const res = await ApiService.suggest(search, category);
+        if (res.ok) setSuggestions(await res.json());
+      } catch (e) { setSuggestions([]); }
+    }, 150);
+    return () => clearTimeout(timeout);
+  }, [search, category]);
+
+  const loadMore = async () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const res = await ApiService.searchVideos(search, category, nextCursor);
+      if (res.ok) {
+        const page = await res.json();
+        setVideos(prev => [...prev, ...page]);
+        setNextCursor(res.headers.get("X-Next-Cursor"));
+      }
+    } catch (e) { console.error("Search failed", e); }
+    finally { setLoadingMore(false); }
+  };
+
   const handlePlay = async (videoId: string) => {
     try {
       const res = await ApiService.getPlayUrl(videoId);
       if (res.ok) {
         const data = await res.json();
-        setPlayingUrl(data.url); 
+        setPlaying({ url: data.url, format: data.format });
       } else { alert("Login required to play."); }
     } catch (err) { console.error(err); }
   };
@@ -69,10 +101,10 @@ export default function PublicFeed() {
         video={activeSummaryVideo} 
       />
 
-      {playingUrl && (
+      {playing && (
         <div className="fixed inset-0 z-50 bg-black/90 flex flex-col items-center justify-center p-4 backdrop-blur-sm">
-          <button onClick={() => setPlayingUrl(null)} className="absolute top-8 right-8 text-white text-4xl font-bold hover:text-red-500 transition-colors">✕</button>
-          <video src={playingUrl} controls autoPlay className="max-w-full max-h-[80vh] border-4 border-white shadow-[0px_0px_50px_rgba(255,255,255,0.3)]" />
+          <button onClick={() => setPlaying(null)} className="absolute top-8 right-8 text-white text-4xl font-bold hover:text-red-500 transition-colors">✕</button>
+          <VideoPlayer key={playing.url} src={playing.url} format={playing.format} className="max-w-full max-h-[80vh] border-4 border-white shadow-[0px_0px_50px_rgba(255,255,255,0.3)]" />
         </div>
       )}
 
@@ -80,7 +112,10 @@ export default function PublicFeed() {
         <h1 className="text-5xl font-black mb-8 uppercase tracking-tighter">Public Gallery</h1>
         
         <div className="flex flex-col md:flex-row gap-4 mb-12">
-          <input type="text" placeholder="Search videos..." className="flex-1 border-4 border-black p-4 font-bold text-xl shadow-[4px_4px_0px_0px_rgba(0,0,0,1)] focus:outline-none focus:translate-x-[2px] focus:translate-y-[2px] transition-all" value={search} onChange={(e) => setSearch(e.target.value)}/>
+          <input type="text" placeholder="Search videos..." className="flex-1 border-4 border-black p-4 font-bold text-xl shadow-[4px_4px_0px_0px_rgba(0,0,0,1)] focus:outline-none focus:translate-x-[2px] focus:translate-y-[2px] transition-all" value={search} onChange={(e) => setSearch(e.target.value)} list="video-suggestions"/>
+          <datalist id="video-suggestions">
+            {suggestions.map(s => <option key={s.id} value={s.title} />)}
+          </datalist>
           <select className="border-4 border-black p-4 font-bold text-xl shadow-[4px_4px_0px_0px_rgba(0,0,0,1)] cursor-pointer bg-white" value={category} onChange={(e) => setCategory(e.target.value)}>
             {categories.map(cat => <option key={cat} value={cat}>{cat}</option>)}
           </select>
@@ -127,6 +162,14 @@ export default function PublicFeed() {
             )}
           </div>
         )}
+
+        {!loading && nextCursor && (
+          <div className="flex justify-center mt-12">
+            <button onClick={loadMore} disabled={loadingMore} className="border-4 border-black px-8 py-3 font-black text-xl bg-white shadow-[4px_4px_0px_0px_rgba(0,0,0,1)] hover:bg-gray-100 active:shadow-none active:translate-y-[2px] transition-all disabled:opacity-50">
+              {loadingMore ? "LOADING..." : "LOAD MORE"}
+            </button>
+          </div>
+        )}
       </div>
     </div>
   );
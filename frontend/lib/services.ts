@@ -159,10 +159,12 @@ export const ApiService = {
     });
   },
 
-  async searchVideos(query: string, category: string): Promise<Response> {
+  async searchVideos(query: string, category: string, cursor?: string): Promise<Response> {
     const params = new URLSearchParams();
     if (query) params.append("q", query);
     if (category && category !== "All") params.append("category", category);
+    // Opaque cursor from the previous page's X-Next-Cursor header.
+    if (cursor) params.append("cursor", cursor);
 
     return await fetch(`${API_URL}/videos/search?${params.toString()}`, {
       method: "GET",
@@ -171,6 +173,17 @@ export const ApiService = {
     });
   },
 
+  async suggest(query: string, category: string): Promise<Response> {
+    const params = new URLSearchParams({ q: query });
+    if (category && category !== "All") params.append("category", category);
+
+    return await fetch(`${API_URL}/videos/suggest?${params.toString()}`, {
+      method: "GET",
+      headers: { "Content-Type": "application/json" },
+      credentials: "include",
+    });
+  },
+
   async getPlayUrl(videoId: string): Promise<Response> {
     // OLD: headers: getAuthHeader()
     return await fetchWithAuth(`${API_URL}/videos/play/${videoId}`);
@@ -13,6 +13,8 @@ export interface Video {
   is_deleted: boolean;
   owner_email?: string;
   summary?: string | null;
+  progress?: number | null;
+  eta_seconds?: number | null;
 }
 
 export interface User {